@@ -0,0 +1,187 @@
+"""
+Benchmark of the sequence index: build, save/load and query latency and
+throughput at several radii, for every index engine compared.
+
+    python -m benchmarks.bench_index --count 10000 --radii 0,5,20,50 -o results.jsonl
+    python -m benchmarks.bench_index --fasta corpus.fa --engines server.index.engines.BKTreeEngine,\
+server.index.engines.VPTreeEngine
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks.common import Reporter, latency_summary, add_output_argument
+from benchmarks.fasta import generate, mutate, add_generator_arguments, generator_options, ALPHABETS
+from server.config import Config
+from server.index.sequence_index import SequenceIndex, QueryStats, DEFAULT_ENGINE
+from server.ingest import read_fasta
+
+# the server defaults
+CONFIG = Config()
+
+
+def read_records(path):
+    with open(path, 'rb') as file:
+        return [(sequence_id, description, sequence) for _, sequence_id, description, sequence in read_fasta(file)]
+
+
+def build(idx_dir, records, engine, seed_stride, lsh, neighbourhood_max_length):
+    idx = SequenceIndex()
+    idx.engine = engine
+    idx.neighbourhood_max_length = neighbourhood_max_length
+    idx.seed_stride = seed_stride
+    idx.lsh_bands, idx.lsh_rows = [int(value) for value in lsh.split('x')]
+    idx.load(idx_dir, force=True)
+
+    for sequence_id, _, sequence in records:
+        idx.add({'name': sequence_id, 'sequence': sequence})
+
+    return idx
+
+
+def fragment(rng, sequence, length):
+    if not length or length >= len(sequence):
+        return sequence
+
+    start = rng.randrange(len(sequence) - length)
+    return sequence[start:start + length]
+
+
+def accuracy(idx, queries, radius, options, find):
+    """Recall and precision of the approximate results against the exact ones within `radius`"""
+    true_positives, expected, returned = 0, 0, 0
+    for query in queries:
+        item = {'sequence': query, 'strand': options.strand}
+        exact = {name for hit in idx.find(item, radius) for name in hit[1]['names']}
+        approximate = {name for hit in find(item, radius, QueryStats()) for name in hit[1]['names']}
+        true_positives += len(exact & approximate)
+        expected += len(exact)
+        returned += len(approximate)
+
+    return {'recall': true_positives / expected if expected else None,
+            'precision': true_positives / returned if returned else None,
+            'similarity': options.similarity, 'rerank': options.rerank}
+
+
+def run(options, reporter):
+    if options.fasta:
+        parameters = {'fasta': options.fasta}
+        records = read_records(options.fasta)
+    else:
+        parameters = generator_options(options)
+        records = list(generate(**parameters))
+
+    rng = random.Random(options.seed + 1)
+    queries = [mutate(rng, fragment(rng, sequence, options.fragment_length), options.query_mutation_rate,
+                      ALPHABETS[options.alphabet])
+               for _, _, sequence in rng.sample(records, min(options.queries, len(records)))]
+
+    for engine in options.engines.split(','):
+        run_engine(options, reporter, dict(parameters, engine=engine), records, queries)
+
+
+def run_engine(options, reporter, parameters, records, queries):
+    idx_dir = tempfile.mkdtemp()
+
+    try:
+        start = time.perf_counter()
+        idx = build(idx_dir, records, parameters['engine'], options.seed_stride, options.lsh,
+                    options.neighbourhood_max_length)
+        seconds = time.perf_counter() - start
+        reporter.emit('index_build', parameters=parameters, seconds=seconds,
+                      sequences_per_second=len(records) / seconds)
+
+        start = time.perf_counter()
+        idx.save()
+        seconds = time.perf_counter() - start
+        reporter.emit('index_save', parameters=parameters, seconds=seconds,
+                      bytes=os.path.getsize(os.path.join(idx_dir, 'idx.pk')))
+
+        start = time.perf_counter()
+        idx.load(idx_dir, force=True)
+        reporter.emit('index_load', parameters=parameters, seconds=time.perf_counter() - start)
+
+        finders = {
+            'global': idx.find,
+            'local': idx.find_local,
+            'approximate': lambda item, radius, stats: idx.find_approximate(
+                item, options.similarity, options.rerank, radius if options.rerank else None, stats=stats)
+        }
+        find = finders[options.mode]
+
+        # indexes left out of the build (--seed-stride 0, --lsh 0x0) are built after the first query
+        start = time.perf_counter()
+        find({'sequence': queries[0], 'strand': options.strand}, 0, QueryStats())
+        if idx.lazy_builds:
+            for future in idx.lazy_builds.values():
+                future.result()
+            reporter.emit('index_lazy_build', parameters=parameters, mode=options.mode,
+                          seconds=time.perf_counter() - start)
+        for radius in [int(radius) for radius in options.radii.split(',')]:
+            latencies, visited, computations, hits = [], 0, 0, 0
+            start = time.perf_counter()
+            for query in queries:
+                stats = QueryStats()
+                find({'sequence': query, 'strand': options.strand}, radius, stats=stats)
+                latencies.append(stats.elapsed)
+                visited += stats.nodes_visited
+                computations += stats.distance_computations
+                hits += stats.hits
+            seconds = time.perf_counter() - start
+
+            extra = accuracy(idx, queries, radius, options, find) if options.mode == 'approximate' else {}
+            reporter.emit('index_query', parameters=parameters, mode=options.mode, radius=radius,
+                          strand=options.strand, queries=len(queries), queries_per_second=len(queries) / seconds,
+                          mean_nodes_visited=visited / len(queries),
+                          mean_distance_computations=computations / len(queries), mean_hits=hits / len(queries),
+                          **extra, **latency_summary(latencies))
+    finally:
+        shutil.rmtree(idx_dir, ignore_errors=True)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Sequence index benchmark')
+    add_generator_arguments(parser)
+    add_output_argument(parser)
+    parser.add_argument('--fasta', help='Benchmark on the records of this FASTA file instead of generated ones.')
+    parser.add_argument('--engines', default=DEFAULT_ENGINE,
+                        help='Comma separated index engine classes to compare [default: %(default)s].')
+    parser.add_argument('--radii', default='0,5,20,50', help='Comma separated query radii [default: %(default)s].')
+    parser.add_argument('--queries', default=200, type=int, help='Queries per radius [default: %(default)s].')
+    parser.add_argument('--strand', default='plus', choices=['plus', 'minus', 'both'],
+                        help='Strands searched for nucleotide queries [default: %(default)s].')
+    parser.add_argument('--mode', default='global', choices=['global', 'local', 'approximate'],
+                        help='Whole sequence, local (fragment) or approximate (MinHash) queries, approximate '
+                             'queries also report their recall and precision against the exact results within '
+                             'each radius [default: %(default)s].')
+    parser.add_argument('--similarity', default=0.5, type=float,
+                        help='Minimum estimated similarity of approximate queries [default: %(default)s].')
+    parser.add_argument('--rerank', default=0, type=int,
+                        help='Exact re-ranking of the most similar approximate candidates [default: %(default)s].')
+    parser.add_argument('--lsh', default='{}x{}'.format(CONFIG.INDEX_LSH_BANDS, CONFIG.INDEX_LSH_ROWS),
+                        help='LSH bands x rows of the index built for approximate queries, 0x0 builds it after '
+                             'the first approximate query [default: %(default)s].')
+    parser.add_argument('--fragment-length', default=0, type=int,
+                        help='Query with fragments of this length of the sampled sequences, 0 queries '
+                             'whole sequences [default: %(default)s].')
+    parser.add_argument('--seed-stride', default=CONFIG.INDEX_SEED_STRIDE, type=int,
+                        help='Sampling stride of the local search seed index, 0 builds it after the first local '
+                             'query [default: %(default)s].')
+    parser.add_argument('--neighbourhood-max-length', default=CONFIG.INDEX_NEIGHBOURHOOD_MAX_LENGTH, type=int,
+                        help='Longest query answered with neighbourhood lookups at radius 1 [default: %(default)s].')
+    parser.add_argument('--query-mutation-rate', default=0.01, type=float,
+                        help='Mutation rate applied to the sampled query sequences [default: %(default)s].')
+    options = parser.parse_args(arguments)
+
+    reporter = Reporter(options.output)
+    try:
+        run(options, reporter)
+    finally:
+        reporter.close()
+
+
+if __name__ == '__main__':
+    main()
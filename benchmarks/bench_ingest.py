@@ -0,0 +1,85 @@
+"""
+Benchmark of the FASTA ingestion job (:func:`recreate_idx`) against a local mongod.
+A throwaway database is used and dropped at the end of the run.
+
+    python -m benchmarks.bench_ingest --count 5000 --mongodb-url mongodb://localhost:27017/
+    python -m benchmarks.bench_ingest --count 5000 --codec server.sequence_codecs.PackedCodec
+"""
+import argparse
+import shutil
+import tempfile
+import time
+import os
+
+from pymongo import MongoClient
+
+from benchmarks.common import Reporter, add_output_argument
+from benchmarks.fasta import generate, write_fasta, add_generator_arguments, generator_options
+from server.ingest import recreate_idx
+from server.index.sequence_index import SequenceIndex
+from server.sequence_codecs import decode
+
+
+def run(options, reporter):
+    parameters = generator_options(options)
+    work_dir = tempfile.mkdtemp()
+    client = MongoClient(options.mongodb_url)
+
+    try:
+        fasta = write_fasta(os.path.join(work_dir, 'bench.fa'), generate(**parameters))
+        client.drop_database(options.database)
+        SequenceIndex().load(work_dir, force=True)
+
+        start = time.perf_counter()
+        recreate_idx(options.mongodb_url, options.database, 'bench_job', fasta, work_dir, options.partitions,
+                     codec=options.codec, chunk_size=options.chunk_size)
+        seconds = time.perf_counter() - start
+
+        database = client[options.database]
+        job = database.job.find_one({'_id': 'bench_job'})
+        inserted = database.sequence.count_documents({})
+        collection = database.command('collStats', 'sequence')
+        reporter.emit('ingest', parameters=parameters, partitions=options.partitions, codec=options.codec,
+                      chunk_size=options.chunk_size, seconds=seconds, inserted=inserted,
+                      status=job and job.get('status'), sequences_per_second=inserted / seconds,
+                      data_bytes=collection['size'], storage_bytes=collection['storageSize'],
+                      chunks=database.sequence_chunk.count_documents({}))
+
+        start = time.perf_counter()
+        documents = list(database.sequence.find({}, {'sequence': 1}))
+        read_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for document in documents:
+            decode(document.get('sequence', ''))
+        reporter.emit('sequence_read', parameters=parameters, codec=options.codec, documents=len(documents),
+                      read_seconds=read_seconds, decode_seconds=time.perf_counter() - start)
+    finally:
+        client.drop_database(options.database)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='FASTA ingestion benchmark')
+    add_generator_arguments(parser)
+    add_output_argument(parser)
+    parser.add_argument('--mongodb-url', default='mongodb://localhost:27017/',
+                        help='Local mongod used for the run [default: %(default)s].')
+    parser.add_argument('--database', default='dnaAPI_bench',
+                        help='Throwaway database, dropped before and after the run [default: %(default)s].')
+    parser.add_argument('--codec', default='server.sequence_codecs.PlainCodec',
+                        help='Storage codec of the sequences [default: %(default)s].')
+    parser.add_argument('--chunk-size', default=262144, type=int,
+                        help='Sequences longer than this are stored in chunks [default: %(default)s].')
+    parser.add_argument('--partitions', default=1, type=int,
+                        help='Index build worker processes [default: %(default)s].')
+    options = parser.parse_args(arguments)
+
+    reporter = Reporter(options.output)
+    try:
+        run(options, reporter)
+    finally:
+        reporter.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark of the api response serializers against the stdlib Encoder.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_serializer --docs 1000 --repeat 20
+"""
+import argparse
+import datetime
+import random
+import timeit
+
+from bson import ObjectId
+
+from benchmarks.common import Reporter, add_output_argument
+from server.json_encoder import StdlibSerializer, OrjsonSerializer, orjson
+
+
+def make_page(docs, sequence_size):
+    now = datetime.datetime.now()
+    return [{
+        '_id': ObjectId(),
+        'sequence_id': 'seq{}'.format(i),
+        'tags': 'synthetic sequence {}'.format(i),
+        'sequence': ''.join(random.choice('ACGT') for _ in range(sequence_size)),
+        'sequence_size': sequence_size,
+        'distance': random.randint(0, 50),
+        'created_date': now,
+        'last_modified_date': now,
+    } for i in range(docs)]
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Serializer benchmark')
+    parser.add_argument('--docs', default=1000, type=int, help='Documents per page [default: %(default)s].')
+    parser.add_argument('--sequence-size', default=400, type=int, help='Sequence length [default: %(default)s].')
+    parser.add_argument('--repeat', default=20, type=int, help='Encodes per serializer [default: %(default)s].')
+    add_output_argument(parser)
+    options = parser.parse_args(arguments)
+
+    random.seed(0)
+    page = make_page(options.docs, options.sequence_size)
+
+    serializers = {'stdlib': StdlibSerializer()}
+    if orjson:
+        serializers['orjson'] = OrjsonSerializer()
+
+    reporter = Reporter(options.output)
+    for name, serializer in serializers.items():
+        seconds = min(timeit.repeat(lambda: serializer.dumps(page), number=1, repeat=options.repeat))
+        reporter.emit('serializer', serializer=name, docs=options.docs, bytes=len(serializer.dumps(page)),
+                      seconds=seconds, docs_per_second=options.docs / seconds)
+    reporter.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Every benchmark writes one JSON document per measurement (JSON lines) to
+stdout and optionally appends it to an output file, each record carries the
+git revision so runs can be compared between commits.
+"""
+import datetime
+import json
+import subprocess
+import sys
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Reporter:
+    def __init__(self, output=None):
+        self.revision = git_revision()
+        self.timestamp = datetime.datetime.now().isoformat()
+        self.output = open(output, 'a') if output else None
+
+    def emit(self, benchmark, **values):
+        record = json.dumps({'benchmark': benchmark, 'revision': self.revision, 'timestamp': self.timestamp,
+                             **values})
+        sys.stdout.write(record + '\n')
+        sys.stdout.flush()
+        if self.output:
+            self.output.write(record + '\n')
+
+    def close(self):
+        if self.output:
+            self.output.close()
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+
+    values = sorted(values)
+    k = (len(values) - 1) * percent / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def latency_summary(seconds):
+    """Latency percentiles in milliseconds for a list of durations in seconds"""
+    return {
+        'p50_ms': percentile(seconds, 50) * 1000,
+        'p95_ms': percentile(seconds, 95) * 1000,
+        'p99_ms': percentile(seconds, 99) * 1000,
+        'max_ms': max(seconds) * 1000,
+    }
+
+
+def add_output_argument(parser):
+    parser.add_argument('-o', '--output', default=None,
+                        help='Append the JSON lines results to this file [default: %(default)s].')
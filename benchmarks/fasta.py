@@ -0,0 +1,107 @@
+"""
+Synthetic FASTA generator.
+
+Sequences are generated in families: each family has a random root sequence and
+its members are copies of the root with point substitutions, insertions and
+deletions applied at `mutation_rate`, which gives the index realistic clusters
+of similar sequences.
+
+    python -m benchmarks.fasta --count 10000 --min-length 50 --max-length 400 out.fa
+"""
+import argparse
+import random
+
+ALPHABETS = {
+    'dna': 'ACGT',
+    'protein': 'ACDEFGHIKLMNPQRSTVWY',
+}
+
+
+def random_length(rng, min_length, max_length, distribution):
+    if distribution == 'normal':
+        mean = (min_length + max_length) / 2.0
+        sigma = (max_length - min_length) / 6.0 or 1
+        return int(min(max_length, max(min_length, rng.gauss(mean, sigma))))
+
+    return rng.randint(min_length, max_length)
+
+
+def mutate(rng, sequence, mutation_rate, alphabet):
+    mutated = []
+    for base in sequence:
+        if rng.random() >= mutation_rate:
+            mutated.append(base)
+            continue
+
+        operation = rng.random()
+        if operation < 0.6:
+            mutated.append(rng.choice(alphabet))
+        elif operation < 0.8:
+            mutated.append(base)
+            mutated.append(rng.choice(alphabet))
+        # else deletion
+
+    return ''.join(mutated)
+
+
+def generate(count, min_length=50, max_length=400, distribution='uniform', mutation_rate=0.02,
+             family_size=20, alphabet='dna', seed=0):
+    """
+    Yields (sequence_id, description, sequence) tuples.
+    """
+    rng = random.Random(seed)
+    letters = ALPHABETS[alphabet]
+
+    root = None
+    for index in range(count):
+        if index % family_size == 0:
+            length = random_length(rng, min_length, max_length, distribution)
+            root = ''.join(rng.choice(letters) for _ in range(length))
+
+        family = index // family_size
+        yield ('synthetic_{}'.format(index),
+               'synthetic_{} family={} alphabet={}'.format(index, family, alphabet),
+               mutate(rng, root, mutation_rate, letters))
+
+
+def write_fasta(path, records, line_width=80):
+    with open(path, 'w') as file:
+        for sequence_id, description, sequence in records:
+            file.write('>{}\n'.format(description))
+            for start in range(0, len(sequence), line_width):
+                file.write(sequence[start:start + line_width] + '\n')
+
+    return path
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--count', default=10000, type=int, help='Number of sequences [default: %(default)s].')
+    parser.add_argument('--min-length', default=50, type=int, help='Minimum length [default: %(default)s].')
+    parser.add_argument('--max-length', default=400, type=int, help='Maximum length [default: %(default)s].')
+    parser.add_argument('--distribution', default='uniform', choices=['uniform', 'normal'],
+                        help='Length distribution [default: %(default)s].')
+    parser.add_argument('--mutation-rate', default=0.02, type=float,
+                        help='Per base mutation rate inside a family [default: %(default)s].')
+    parser.add_argument('--family-size', default=20, type=int,
+                        help='Sequences derived from the same root [default: %(default)s].')
+    parser.add_argument('--alphabet', default='dna', choices=sorted(ALPHABETS), help='[default: %(default)s].')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed [default: %(default)s].')
+
+
+def generator_options(options):
+    return dict(count=options.count, min_length=options.min_length, max_length=options.max_length,
+                distribution=options.distribution, mutation_rate=options.mutation_rate,
+                family_size=options.family_size, alphabet=options.alphabet, seed=options.seed)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Synthetic FASTA generator')
+    add_generator_arguments(parser)
+    parser.add_argument('path', help='Output FASTA file')
+    options = parser.parse_args(arguments)
+
+    write_fasta(options.path, generate(**generator_options(options)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+HTTP load generator for the api routes.
+
+Drives `/api/crud/<repository>`, `/api/sequence/query` and `/api/sequence/upload`
+with a configurable number of concurrent workers per endpoint for a fixed
+duration and reports p50/p95/p99 latency, throughput and status codes per endpoint.
+
+Either point it to a running server with --url or let it start one locally
+(`start.py` against the mongod configured in application.conf):
+
+    python -m benchmarks.loadtest --start-server --duration 60 \\
+        --crud-concurrency 20 --query-concurrency 2 --query-radius 50 --upload-concurrency 1
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlencode
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+
+from benchmarks.common import Reporter, latency_summary, add_output_argument
+from benchmarks.fasta import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class EndpointStats:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.statuses = Counter()
+
+    def record(self, seconds, status):
+        self.latencies.append(seconds)
+        self.statuses[status] += 1
+
+    def summary(self, duration):
+        summary = {'endpoint': self.name, 'requests': len(self.latencies),
+                   'requests_per_second': len(self.latencies) / duration,
+                   'statuses': {str(status): count for status, count in self.statuses.items()}}
+        if self.latencies:
+            summary.update(latency_summary(self.latencies))
+
+        return summary
+
+
+def multipart_body(field, filename, content):
+    boundary = uuid.uuid4().hex
+    body = ('--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').format(boundary=boundary, field=field,
+                                                                     filename=filename).encode('utf-8')
+    body += content + '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+    return 'multipart/form-data; boundary={}'.format(boundary), body
+
+
+class LoadTest:
+    def __init__(self, options):
+        self.options = options
+        self.url = options.url.rstrip('/')
+        self.client = AsyncHTTPClient()
+        self.deadline = None
+        self.rng = random.Random(options.seed)
+        self.queries = [sequence for _, _, sequence in
+                        generate(100, options.query_min_length, options.query_max_length, seed=options.seed)]
+        self.stats = {}
+
+    def stats_for(self, name):
+        if name not in self.stats:
+            self.stats[name] = EndpointStats(name)
+
+        return self.stats[name]
+
+    def crud_request(self):
+        params = {'limit': 20, 'skip': self.rng.randint(0, self.options.crud_max_skip)}
+        return 'crud_{}'.format(self.options.repository), HTTPRequest(
+            '{}/api/crud/{}?{}'.format(self.url, self.options.repository, urlencode(params)))
+
+    def query_request(self):
+        body = json.dumps({'seq': self.rng.choice(self.queries), 'dist': self.options.query_radius})
+        return 'sequence_query', HTTPRequest('{}/api/sequence/query'.format(self.url), method='POST', body=body,
+                                             headers={'Content-Type': 'application/json'})
+
+    def upload_request(self):
+        records = generate(self.options.upload_count, seed=self.rng.randint(0, 1 << 30))
+        fasta = ''.join('>{}\n{}\n'.format(description, sequence) for _, description, sequence in records)
+        content_type, body = multipart_body('file', 'load.fa', fasta.encode('utf-8'))
+        return 'sequence_upload', HTTPRequest('{}/api/sequence/upload'.format(self.url), method='POST', body=body,
+                                              headers={'Content-Type': content_type})
+
+    @gen.coroutine
+    def worker(self, make_request):
+        while time.perf_counter() < self.deadline:
+            name, request = make_request()
+            request.request_timeout = self.options.request_timeout
+
+            start = time.perf_counter()
+            response = yield self.client.fetch(request, raise_error=False)
+            self.stats_for(name).record(time.perf_counter() - start, response.code)
+
+    @gen.coroutine
+    def run(self):
+        workers = [(self.crud_request, self.options.crud_concurrency),
+                   (self.query_request, self.options.query_concurrency),
+                   (self.upload_request, self.options.upload_concurrency)]
+
+        start = time.perf_counter()
+        self.deadline = start + self.options.duration
+        yield [self.worker(make_request) for make_request, concurrency in workers for _ in range(concurrency)]
+        return time.perf_counter() - start
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(options):
+    port = free_port()
+    arguments = [sys.executable, os.path.join(ROOT, 'start.py'), '-p', str(port), '-i', '127.0.0.1']
+    if options.conf:
+        arguments += ['-c', options.conf]
+
+    process = subprocess.Popen(arguments, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}'.format(port)
+
+    deadline = time.time() + options.startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Server exited with code {}'.format(process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, url
+        except OSError:
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError('Server did not start in {} seconds'.format(options.startup_timeout))
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='HTTP load generator')
+    add_output_argument(parser)
+    parser.add_argument('--url', default='http://127.0.0.1:8888', help='Server url [default: %(default)s].')
+    parser.add_argument('--start-server', default=False, action='store_true',
+                        help='Start a local server with start.py on a free port (ignores --url).')
+    parser.add_argument('-c', '--conf', default=None, help='Configuration file for the started server.')
+    parser.add_argument('--startup-timeout', default=600, type=int,
+                        help='Seconds to wait for the started server to bind [default: %(default)s].')
+    parser.add_argument('--duration', default=30, type=int, help='Test duration in seconds [default: %(default)s].')
+    parser.add_argument('--request-timeout', default=600, type=int,
+                        help='Per request timeout in seconds [default: %(default)s].')
+    parser.add_argument('--repository', default='sequence', help='CRUD repository [default: %(default)s].')
+    parser.add_argument('--crud-concurrency', default=10, type=int, help='[default: %(default)s].')
+    parser.add_argument('--crud-max-skip', default=1000, type=int, help='[default: %(default)s].')
+    parser.add_argument('--query-concurrency', default=2, type=int, help='[default: %(default)s].')
+    parser.add_argument('--query-radius', default=20, type=int, help='[default: %(default)s].')
+    parser.add_argument('--query-min-length', default=50, type=int, help='[default: %(default)s].')
+    parser.add_argument('--query-max-length', default=400, type=int, help='[default: %(default)s].')
+    parser.add_argument('--upload-concurrency', default=0, type=int, help='[default: %(default)s].')
+    parser.add_argument('--upload-count', default=1000, type=int,
+                        help='Sequences per uploaded FASTA file [default: %(default)s].')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed [default: %(default)s].')
+    options = parser.parse_args(arguments)
+
+    concurrency = options.crud_concurrency + options.query_concurrency + options.upload_concurrency
+    AsyncHTTPClient.configure(None, max_clients=max(concurrency, 1))
+
+    process = None
+    if options.start_server:
+        process, options.url = start_server(options)
+
+    reporter = Reporter(options.output)
+    try:
+        load_test = LoadTest(options)
+        duration = IOLoop.current().run_sync(load_test.run)
+
+        concurrency = {'crud': options.crud_concurrency, 'query': options.query_concurrency,
+                       'upload': options.upload_concurrency}
+        for name in sorted(load_test.stats):
+            reporter.emit('loadtest', duration=duration, concurrency=concurrency, query_radius=options.query_radius,
+                          **load_test.stats[name].summary(duration))
+    finally:
+        reporter.close()
+        if process:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import json
+import logging
+import sys
+
+from start import get_config
+from server.rebuild import build_index, verify_index, READ_BATCH_SIZE
+
+
+def get_parameters(arguments=None):
+    parser = argparse.ArgumentParser(description='Offline build and verification of the sequence index')
+
+    parser.add_argument(
+        'command', choices=['build', 'verify'],
+        help="build: rebuild idx.pk from the sequence collection, "
+             "verify: compare idx.pk with the sequence collection and report the drift."
+    )
+
+    parser.add_argument(
+        '-c', '--conf', default=None,
+        help="The path of the configuration file to use [default: %(default)s]."
+    )
+
+    parser.add_argument(
+        '-w', '--workers', default=None, type=int,
+        help="Worker processes, 0 means one per cpu [default: INDEX_BUILD_WORKERS]."
+    )
+
+    parser.add_argument(
+        '-b', '--batch-size', default=READ_BATCH_SIZE, type=int,
+        help="Documents fetched per cursor batch [default: %(default)s]."
+    )
+
+    parser.add_argument(
+        "-l", "--log-level", default="info",
+        help="The log level to be used. Possible values are: debug, info, warning, error, critical or notset. "
+             "[default: %(default)s]."
+    )
+
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    '''
+    Rebuilds or verifies the index of the configured database. The server only
+    reads the new index on restart, no ingestion job should run during a build.
+    Exits with 1 when verify finds any drift.
+    '''
+    parameters = get_parameters(arguments)
+    logging.basicConfig(level=getattr(logging, parameters.log_level.upper()))
+    config = get_config(parameters.conf)
+    workers = parameters.workers if parameters.workers is not None else config.INDEX_BUILD_WORKERS
+
+    if parameters.command == 'build':
+        shard_options = {'seed_stride': config.INDEX_SEED_STRIDE, 'lsh_bands': config.INDEX_LSH_BANDS,
+                         'lsh_rows': config.INDEX_LSH_ROWS}
+        report = build_index(config.MONGODB_URL, config.MONGODB_DATABASE, config.INDEX_DIR, workers,
+                             config.INDEX_ENGINE, shard_options, parameters.batch_size)
+        print(json.dumps(report))
+        return 0
+
+    report = verify_index(config.MONGODB_URL, config.MONGODB_DATABASE, config.INDEX_DIR, workers,
+                          parameters.batch_size)
+    print(json.dumps(report, indent=4))
+    return 1 if report['missing'] or report['orphaned'] or report['changed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+from concurrent.futures.thread import ThreadPoolExecutor
+from datetime import timedelta
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+from tornado.web import HTTPError
+
+from server.metrics import QUERY_ADMISSIONS, HEAVY_QUERIES_IN_FLIGHT
+from server.utils import Singleton
+
+
+class QueryAdmission(metaclass=Singleton):
+    """
+    Admission control of the similarity queries from their estimated cost
+    (:meth:`SequenceIndex.estimate_cost`):
+
+     - queries above QUERY_MAX_COST are rejected
+     - queries above QUERY_HEAVY_COST run in a pool of QUERY_HEAVY_CONCURRENCY
+       threads, waiting at most QUERY_QUEUE_TIMEOUT for a free slot, so the
+       event loop keeps serving the cheap queries and the other requests
+     - cheaper queries run right away
+    """
+
+    def __init__(self):
+        self.max_cost = 0
+        self.heavy_cost = 0
+        self.semaphore = None
+        self.executor = None
+        self.queue_timeout = None
+
+    def configure(self, config):
+        concurrency = max(config.QUERY_HEAVY_CONCURRENCY, 1)
+
+        self.max_cost = config.QUERY_MAX_COST
+        self.heavy_cost = config.QUERY_HEAVY_COST
+        self.queue_timeout = timedelta(seconds=config.QUERY_QUEUE_TIMEOUT)
+        self.semaphore = Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    @gen.coroutine
+    def run(self, cost, function, *args):
+        """
+        Runs `function(*args)` as a query of estimated `cost`
+
+        :raises HTTPError 400 over budget, 503 when no slot frees up in time
+        """
+        if self.max_cost and cost > self.max_cost:
+            QUERY_ADMISSIONS.inc('rejected')
+            raise HTTPError(400, reason='Query too expensive: estimated cost {} is over {}, lower its distance or '
+                                        're-ranking'.format(cost, self.max_cost))
+
+        if self.executor is None or cost <= self.heavy_cost:
+            QUERY_ADMISSIONS.inc('inline')
+            return function(*args)
+
+        try:
+            yield self.semaphore.acquire(timeout=self.queue_timeout)
+        except gen.TimeoutError:
+            QUERY_ADMISSIONS.inc('timeout')
+            raise HTTPError(503, reason='Too many expensive queries running, retry later')
+
+        QUERY_ADMISSIONS.inc('heavy')
+        HEAVY_QUERIES_IN_FLIGHT.inc()
+        try:
+            result = yield IOLoop.current().run_in_executor(self.executor, function, *args)
+        finally:
+            HEAVY_QUERIES_IN_FLIGHT.dec()
+            self.semaphore.release()
+
+        return result
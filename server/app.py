@@ -1,8 +1,12 @@
 import tornado
+from tornado.ioloop import IOLoop
 from tornado.web import Application
 
-from server.handlers import IndexHandler, CrudHandler
-from server.handlers.sequence import SequenceUploadHandler, SequenceQueryHandler
+from server.handlers import IndexHandler, CrudHandler, MetricsHandler, HealthHandler, ReadyHandler
+from server.handlers.sequence import SequenceUploadHandler, SequenceQueryHandler, SequenceBodyHandler, \
+    SequenceExportHandler
+from server.admission import QueryAdmission
+from server.ingest import IngestQueue
 
 
 class Application(tornado.web.Application):
@@ -16,11 +20,21 @@ class Application(tornado.web.Application):
         super(Application, self).__init__(handlers,
                                           debug=False, autoreload=False)
 
+        IOLoop.current().spawn_callback(self.context.load_indexes_async)
+        IngestQueue().start(self.context)
+        QueryAdmission().configure(self.context.config)
+
     def get_handlers(self):
         handlers = [
             (r'/api/crud/(?P<repository>\w+)', CrudHandler, {'context': self.context}),
             (r'/api/sequence/upload', SequenceUploadHandler, {'context': self.context}),
+            (r'/api/sequence/upload/(?P<job_id>\w+)', SequenceUploadHandler, {'context': self.context}),
             (r'/api/sequence/query', SequenceQueryHandler, {'context': self.context}),
+            (r'/api/sequence/export', SequenceExportHandler, {'context': self.context}),
+            (r'/api/sequence/(?P<_id>\w+)/body', SequenceBodyHandler, {'context': self.context}),
+            (r'/metrics', MetricsHandler),
+            (r'/healthz', HealthHandler),
+            (r'/readyz', ReadyHandler, {'context': self.context}),
 
             (r"/assets/img/(.*)", tornado.web.StaticFileHandler, {"path": "dist/assets/img"}),
             (r"/dist/(.*)", tornado.web.StaticFileHandler, {"path": "dist"}),
@@ -27,6 +27,28 @@ Config.define(
     'MONGODB_DATABASE', 'dnaAPI',
     'mongodb database', 'mongodb database')
 
+Config.define(
+    'SEQUENCE_CODEC', 'server.sequence_codecs.PlainCodec',
+    'Full python path of the codec storing the sequence field of the sequence documents: '
+    'server.sequence_codecs.PlainCodec (strings), server.sequence_codecs.ZlibCodec (zlib compressed binary) or '
+    'server.sequence_codecs.PackedCodec (2 bits per nucleotide, zlib for anything else than ACGT). '
+    'Documents written with any codec stay readable after changing it.', 'mongodb database'
+)
+
+Config.define(
+    'SEQUENCE_CHUNK_SIZE', 262144,
+    'Sequences longer than this many letters are split in chunks of this size, stored in the sequence_chunk '
+    'collection with the SEQUENCE_CODEC codec, their documents only keep the metadata', 'mongodb database'
+)
+
+Config.define(
+    'DOCUMENT_CACHE', {},
+    'Read-through caches of find_one by _id, per collection name, ex. {"sequence": {"size": 1024, "ttl": 60, '
+    '"max_bytes": 67108864}}: at most `size` documents and `max_bytes` bytes of BSON (0 for no limit), kept '
+    '`ttl` seconds. Writes through the repository evict their documents, other writers show after `ttl`',
+    'mongodb database'
+)
+
 # MODELS OPTIONS
 Config.define(
     'REPOSITORIES', {},
@@ -45,6 +67,121 @@ Config.define(
     'Custom index path directory.'
 )
 
+Config.define(
+    'INDEX_ENGINE', 'server.index.engines.BKTreeEngine',
+    'Full python path of the similarity index engine new shards are built with: '
+    'server.index.engines.BKTreeEngine, server.index.engines.VPTreeEngine or '
+    'server.index.engines.BruteForceEngine. Shards built earlier keep their engine until rebuilt.',
+    'Index'
+)
+
+Config.define(
+    'INDEX_NEIGHBOURHOOD_MAX_LENGTH', 128,
+    'Queries with distance 1 for sequences up to this length are answered by hash lookups of every '
+    'sequence at distance 1 instead of a tree traversal, 0 disables it. Distance 0 always uses hash lookups.',
+    'Index'
+)
+
+Config.define(
+    'INDEX_SEED_STRIDE', 4,
+    'Local search (mode "local" of the query api) seeds: the k-mers of the indexed sequences are sampled '
+    'every INDEX_SEED_STRIDE letters when the index is built. Larger strides use less memory but need longer '
+    'exact matches to find a fragment. The seeds make idx.pk several times larger and every build and load '
+    'slower, 0 leaves them out: the seed index of a shard, with a stride of 4, is then built on its first local '
+    'query.',
+    'Index'
+)
+
+Config.define(
+    'INDEX_LOCAL_MAX_CANDIDATES', 32,
+    'Local search: number of seeded candidates, the ones sharing the most seeds with the query, '
+    'that are aligned against the query.',
+    'Index'
+)
+
+Config.define(
+    'INDEX_LSH_BANDS', 20,
+    'Approximate search (mode "approximate" of the query api): MinHash sketches of the k-mer sets of the '
+    'indexed sequences are computed when the index is built and split in INDEX_LSH_BANDS bands of INDEX_LSH_ROWS '
+    'values. More bands find more similar sequences (recall), more rows return fewer dissimilar candidates '
+    '(precision). The sketches make idx.pk larger and every build and load slower, 0 leaves them out: the LSH '
+    'index of a shard, with 20 bands of 3 rows, is then built on its first approximate query.',
+    'Index'
+)
+
+Config.define(
+    'INDEX_LSH_ROWS', 3,
+    'Approximate search: number of sketch values in each LSH band, see INDEX_LSH_BANDS.',
+    'Index'
+)
+
+Config.define(
+    'INDEX_BUILD_WORKERS', 0,
+    'Number of worker processes building index partitions in parallel after an upload, 0 means one per cpu. '
+    'Each partition is served as a shard of the index.', 'Index'
+)
+
+Config.define(
+    'INDEX_MAX_SHARDS', 16,
+    'Every upload appends its partitions to the index as new shards, once a sequence type has more than '
+    'INDEX_MAX_SHARDS shards the merge of the upload rebuilds its smallest shards into one. Queries and loads '
+    'cost more with every shard, merges cost more with fewer. 0 never merges shards.', 'Index'
+)
+
+# INGESTION OPTIONS
+
+Config.define(
+    'INGEST_WORKERS', 2,
+    'Number of upload jobs ingested concurrently.', 'Ingestion'
+)
+
+Config.define(
+    'UPLOAD_DIR', None,
+    'Directory where uploaded files wait for ingestion, defaults to INDEX_DIR/uploads.', 'Ingestion'
+)
+
+Config.define(
+    'JOB_RECOVERY', 'resume',
+    'What to do at startup with the jobs interrupted by a previous server process: '
+    '"resume" continues them from their last checkpoint, "requeue" starts them over '
+    'and "fail" marks them as failed.', 'Ingestion'
+)
+
+Config.define(
+    'INGEST_CHECKPOINT_EVERY', 100000,
+    'Number of records between two checkpoints of a partition index build, 0 disables them.', 'Ingestion'
+)
+
+# API OPTIONS
+
+Config.define(
+    'JSON_SERIALIZER', 'server.json_encoder.FastSerializer',
+    'Full python path of the serializer class used to encode api responses. '
+    'FastSerializer uses orjson when it is installed and falls back to StdlibSerializer otherwise.', 'Api'
+)
+
+Config.define(
+    'QUERY_MAX_COST', 20000000000,
+    'Similarity queries whose estimated cost (letter comparisons, about 3e8 per second) is above this are rejected '
+    'with a 400, 0 disables the limit.', 'Api'
+)
+
+Config.define(
+    'QUERY_HEAVY_COST', 100000000,
+    'Similarity queries whose estimated cost is above this run in a thread pool of QUERY_HEAVY_CONCURRENCY threads, '
+    'cheaper ones run right away.', 'Api'
+)
+
+Config.define(
+    'QUERY_HEAVY_CONCURRENCY', 2,
+    'Number of heavy similarity queries running at the same time, the others wait for a free slot.', 'Api'
+)
+
+Config.define(
+    'QUERY_QUEUE_TIMEOUT', 10,
+    'Seconds a heavy similarity query waits for a free slot before being rejected with a 503.', 'Api'
+)
+
 
 Config.define(
     'APP_CLASS', 'server.app.Application',
@@ -1,15 +1,23 @@
 import functools
+import gc
 import logging
+import os
 import sys
 import traceback
 from asyncio import Future
 from concurrent.futures.process import ProcessPoolExecutor
+from datetime import timedelta
 
 import motor
 from jinja2 import Environment, FileSystemLoader
+from pymongo.errors import PyMongoError
+from tornado import gen
 from tornado.ioloop import IOLoop
+from tornado.locks import Event
 
-from server.index.sequence_index import SequenceIndex
+from server.index.sequence_index import SequenceIndex, iter_shards
+from server.metrics import MongoCommandMetrics
+from server.model import ReferenceLoader
 from server.utils import Singleton, logger
 
 
@@ -39,11 +47,69 @@ class Context:
         self.template_manager = TemplateManager('dist')
 
         self.create_database(importer)
-        self.load_indexes()
-
-    def load_indexes(self):
+        # contexts are created per request, so are the joined documents it caches
+        self.ref_loader = ReferenceLoader(self)
+
+        # set once the background load of the index is over, successful or not
+        self.index_loaded = Event()
+
+    @gen.coroutine
+    def load_indexes_async(self):
+        '''
+        Loads the index in the background (see :meth:`read_index`), the server
+        answers requests (/healthz, /readyz) meanwhile
+        '''
+        try:
+            yield self.read_index(freeze=True)
+            logger.info('Index loaded from {}'.format(self.config.INDEX_DIR))
+        except Exception:
+            # handlers get a new context per request, the error is kept on the index singleton
+            SequenceIndex().load_error = traceback.format_exc()
+            logger.error('Index loading failed: {}'.format(SequenceIndex().load_error))
+        finally:
+            self.index_loaded.set()
+
+    @gen.coroutine
+    def read_index(self, freeze=False):
+        '''
+        Reads idx.pk in a thread one shard at a time and serves the shards once
+        all of them are read, the previous ones meanwhile. Unpickling holds the
+        GIL, the IOLoop only runs between two shards.
+
+        The garbage collector is paused during the read, its collections over
+        the growing index blocked the IOLoop far longer than the unpickling.
+        With `freeze` (the initial load) the loaded index is then frozen out of
+        the later collections, reloads are not: frozen objects are never freed
+        and the shards they replace would stay in memory.
+        '''
         idx = SequenceIndex()
-        idx.load(self.config.INDEX_DIR)
+        idx.neighbourhood_max_length = self.config.INDEX_NEIGHBOURHOOD_MAX_LENGTH
+        idx.engine = self.config.INDEX_ENGINE
+        idx.seed_stride = self.config.INDEX_SEED_STRIDE
+        idx.local_max_candidates = self.config.INDEX_LOCAL_MAX_CANDIDATES
+        idx.lsh_bands = self.config.INDEX_LSH_BANDS
+        idx.lsh_rows = self.config.INDEX_LSH_ROWS
+
+        shards = []
+        file_path = os.path.join(self.config.INDEX_DIR, 'idx.pk')
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            if os.path.exists(file_path):
+                with open(file_path, 'rb') as file:
+                    frames = iter_shards(file)
+                    shard = yield IOLoop.current().run_in_executor(None, next, frames, None)
+                    while shard is not None:
+                        shards.append(shard)
+                        shard = yield IOLoop.current().run_in_executor(None, next, frames, None)
+
+            idx.use_shards(self.config.INDEX_DIR, shards)
+            if freeze:
+                gc.collect()
+                gc.freeze()
+        finally:
+            if collecting:
+                gc.enable()
 
     def create_database(self, importer):
         self.db = Database(self.config.MONGODB_URL, self.config.MONGODB_DATABASE)
@@ -95,22 +161,38 @@ class ContextImporter:
 
 
 class Database(metaclass=Singleton):
-    def __init__(self, url, db_name):
-        from pymongo import MongoClient
+    startup_retry = timedelta(seconds=5)
 
+    def __init__(self, url, db_name):
         self.db_name = db_name
+        self.started = False
+        # set once the indexes are created, the ingest queue waits for it
+        self.ready = Event()
 
         logging.info('Connecting to database {}'.format(url))
-        self.motor_client = motor.motor_tornado.MotorClient(url, connectTimeoutMS=4)
-        self.pymongo_client = MongoClient(url, connectTimeoutMS=4)
+        self.motor_client = motor.motor_tornado.MotorClient(url, connectTimeoutMS=4,
+                                                            event_listeners=[MongoCommandMetrics()])
 
-        self.startup()
+        # runs once the server is listening, an unreachable database must not delay it
+        IOLoop.current().spawn_callback(self.startup)
         # self.changelog_applied = True
 
-    # cleanup hanging jobs
+    # interrupted jobs are recovered by the ingest queue
+    @gen.coroutine
     def startup(self):
-        db = self.pymongo_client[self.db_name]
-        db.job.drop()
+        while not self.started:
+            try:
+                db = self.db
+                yield db.job.create_index([('status', 1), ('created_date', 1)])
+                # makes resumed ingestion jobs idempotent
+                yield db.sequence.create_index([('job_id', 1), ('record', 1)], unique=True,
+                                               partialFilterExpression={'job_id': {'$exists': True}})
+                yield db.sequence_chunk.create_index([('sequence', 1), ('n', 1)], unique=True)
+                self.started = True
+                self.ready.set()
+            except PyMongoError as e:
+                logger.error('Database startup failed, retrying: {}'.format(e))
+                yield gen.sleep(self.startup_retry.total_seconds())
 
     def __getitem__(self, key):
         return self.db[key]
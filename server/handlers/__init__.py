@@ -1,6 +1,7 @@
-import datetime
 import json
+import time
 import traceback
+from datetime import timedelta
 
 import tornado.web
 from tornado import gen
@@ -8,7 +9,9 @@ from tornado.log import app_log
 from tornado.web import HTTPError
 
 from server.context import Context
-from server.json_encoder import Encoder
+from server.index.sequence_index import SequenceIndex
+from server.json_encoder import get_serializer
+from server.metrics import REQUEST_LATENCY, REQUEST_STATUS, REQUESTS_IN_FLIGHT, registry
 from server.model import ValidatorError
 from server.utils import logger, RepositoryMixin, str2bool
 
@@ -37,7 +40,8 @@ class BaseHandler(tornado.web.RequestHandler):
         if not hasattr(self, 'context'):
             return
 
-        self._response_start = datetime.datetime.now()
+        self._response_start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc(type(self).__name__)
 
     @gen.coroutine
     def _execute(self, transforms, *args, **kwargs):
@@ -95,12 +99,13 @@ class BaseHandler(tornado.web.RequestHandler):
     def on_finish(self, *args, **kwargs):
         super(BaseHandler, self).on_finish(*args, **kwargs)
 
-        if not hasattr(self, 'context'):
+        if not hasattr(self, 'context') or not hasattr(self, '_response_start'):
             return
 
-        # total_time = (datetime.datetime.now() - self._response_start).total_seconds() * 1000
-        # status = self.get_status()
-        ## HERE WE CAN LOG METRICS AS REQUEST STATUS AND TOTAL_TIME
+        handler, method = type(self).__name__, self.request.method
+        REQUESTS_IN_FLIGHT.dec(handler)
+        REQUEST_LATENCY.observe(handler, method, value=time.perf_counter() - self._response_start)
+        REQUEST_STATUS.inc(handler, method, self.get_status())
 
 
 class ContextHandler(BaseHandler, RepositoryMixin):
@@ -137,10 +142,13 @@ class ApiHandler(ContextHandler):
     and sets default headers for json REST API and custom error handling
     """
 
+    retry_after = 5
+
     def initialize(self, context):
         ContextHandler.initialize(self, context)
 
         self.limit_default = 20
+        self.serializer = get_serializer(self.context.config.JSON_SERIALIZER)
 
     def compute_etag(self):
         return None
@@ -174,7 +182,10 @@ class ApiHandler(ContextHandler):
         if self.context.server.debug:
             error.update({'stacktrace': lines})
 
-        self.write(json.dumps({'error': error}, cls=Encoder))
+        if status_code == 503:
+            self.set_header('Retry-After', self.retry_after)
+
+        self.write(self.serializer.dumps({'error': error}))
         self.finish()
 
     def prepare(self, *args, **kwargs):
@@ -186,7 +197,7 @@ class ApiHandler(ContextHandler):
 
     def write_json(self, object, status=200):
         self.set_status(status)
-        self.write(json.dumps(object, cls=Encoder))
+        self.write(self.serializer.dumps(object))
 
 
 class CrudHandler(ApiHandler):
@@ -239,6 +250,53 @@ class CrudHandler(ApiHandler):
         self.write_json(result)
 
 
+class MetricsHandler(BaseHandler):
+    """
+    Handler that exposes the in-process metrics in the prometheus text format
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish(registry.expose())
+
+
+class HealthHandler(BaseHandler):
+    """
+    Liveness probe: the process is up and its event loop answers
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({'status': 'ok'}))
+
+
+class ReadyHandler(ApiHandler):
+    """
+    Readiness probe: 200 once the index is loaded and the database answers a
+    ping within `ping_timeout`, 503 with the state of each check otherwise
+    """
+    ping_timeout = timedelta(seconds=2)
+
+    @gen.coroutine
+    def get(self):
+        idx = SequenceIndex()
+        if idx.load_error:
+            index = 'failed'
+        else:
+            index = 'loaded' if idx.loaded else 'loading'
+
+        try:
+            yield gen.with_timeout(self.ping_timeout, self.context.db.db.command('ping'))
+            database = 'ok' if self.context.db.started else 'starting'
+        except Exception:
+            database = 'unreachable'
+
+        ready = index == 'loaded' and database == 'ok'
+        if not ready:
+            self.set_header('Retry-After', self.retry_after)
+        self.write_json({'ready': ready, 'index': index, 'database': database}, 200 if ready else 503)
+
+
 class IndexHandler(ContextHandler):
     """
     Handler that serves the index.html template
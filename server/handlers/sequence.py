@@ -1,138 +1,323 @@
 import io
-import os
-import tempfile
-import traceback
-from datetime import datetime
 import json
 import re
+import time
+import zlib
 from collections import OrderedDict
-from concurrent.futures.process import ProcessPoolExecutor
 
 from Bio import SeqIO, Alphabet
-from pymongo import MongoClient
+from bson import ObjectId
+from tornado.iostream import StreamClosedError
 from tornado.web import HTTPError
 
+from server.admission import QueryAdmission
 from server.handlers import ApiHandler
 from tornado import gen
 
-from server.index.sequence_index import SequenceIndex
-from server.json_encoder import Encoder
-from server.utils import logger
+from server.index.sequence_index import SequenceIndex, QueryStats
+from server.ingest import IngestQueue, FINISHED_STATUSES
+from server.utils import logger, str2bool
 
 
-def recreate_idx(db_url, db, file_path, idx_dir):
-    pymongo_client = MongoClient(db_url, connectTimeoutMS=2)
-    db = pymongo_client[db]
-    try:
-        seqs = list(SeqIO.parse(file_path, 'fasta'))
-        idx = SequenceIndex()
-
-        size = len(seqs)
+class SequenceUploadHandler(ApiHandler):
+    """
+    Queues FASTA uploads for ingestion and reports the status of the jobs.
+    """
 
-        db.job.save({
-            '_id': 'index_job',
-            'status': 'STARTING',
-            'file': file_path,
-            'no_seqs': size - 1,
-            'current_seq': 0,
-            'message': 'Started indexing job'
-        })
+    @gen.coroutine
+    def get(self, job_id=None):
+        if job_id is None:
+            jobs = yield self.job_repository.find({'status': {'$nin': FINISHED_STATUSES}}, sort=('created_date', 1),
+                                                  limit=self.limit, skip=self.skip)
+            self.write_json(jobs)
+            return
 
-        for index, row in enumerate(seqs):
-            name, sequence = row.id, str(row.seq)
-            db.sequence.insert({
-                'sequence_id': name,
-                'tags': row.description,
-                'sequence': sequence,
-                'sequence_size': len(sequence),
-                'last_modified_date': datetime.now()
-            })
+        job = None
+        if ObjectId.is_valid(job_id):
+            job = yield self.job_repository.find_one({'_id': job_id})
 
-            idx.add({'name': name, 'sequence': sequence})
+        if not job:
+            raise HTTPError(404, reason='Job not found')
 
-            db.job.update({'_id': 'index_job'}, {'$set': {'current_seq': index,
-                                                          'message': 'We are at {}/{} from the indexing process'.format(
-                                                              index, size),
-                                                          'percent': round((index + 1) / size * 50 + 15)}})
+        self.write_json(job, 200 if job['status'] in FINISHED_STATUSES else 206)
 
-        db.job.update({'_id': 'index_job'}, {
-            '$set': {'status': 'FINISHED_INSERT', 'message': 'Saving index to disk... this may take a while',
-                     'percent': 70}})
+    @gen.coroutine
+    def post(self, job_id=None):
+        if job_id is not None:
+            job = None
+            if ObjectId.is_valid(job_id):
+                job = yield IngestQueue().retry(job_id)
 
-        idx.save('idx_new')
-        os.replace(os.path.join(idx_dir, 'idx_new.pk'), os.path.join(idx_dir, 'idx.pk'))
+            if not job:
+                raise HTTPError(404, reason='No failed job to resume')
 
-        db.job.update({'_id': 'index_job'},
-                      {'$set': {'status': 'FINISHED_SAVE', 'message': 'Saved index to disk', 'percent': 80}})
-    except:
-        print(traceback.format_exc())
-        db.job.update({'_id': 'index_job'}, {'$set': {'status': 'FAILED', 'message': 'Failed job', 'percent': 100}})
+            self.write_json(job, 202)
+            return
 
+        file = self.request.files['file'][0]
+        job = yield IngestQueue().enqueue(file.filename, file.body)
 
-class SequenceUploadHandler(ApiHandler):
-    executor = ProcessPoolExecutor(max_workers=1)
+        self.write_json(job, 202)
 
-    @gen.coroutine
-    def get(self):
-        job = yield self.job_repository.find_one({'_id': 'index_job'}, process_query=False)
-        if job and job['status'] != 'FAILED' and job['status'] != 'DONE':
-            self.write_json(job, 206)
-            return
 
-        self.set_status(200)
+class SequenceBodyHandler(ApiHandler):
+    """
+    Ranged reads of a sequence: letters `start` (inclusive) to `end` (exclusive),
+    the whole sequence by default. Only the chunks holding the range are fetched.
+    """
 
     @gen.coroutine
-    def post(self):
-        job = yield self.job_repository.find_one({'_id': 'index_job'}, process_query=False)
-        if job and job['status'] != 'FAILED' and job['status'] != 'DONE':
-            self.write_json(job, 206)
-            return
+    def get(self, _id):
+        try:
+            start = int(self.get_argument('start', 0))
+            end = self.get_argument('end', None)
+            end = int(end) if end is not None else None
+        except ValueError:
+            raise HTTPError(400, reason='start and end must be integers')
 
-        file = self.request.files['file'][0]
-        yield self.job_repository.save({'_id': 'index_job', 'status': 'SAVING_FILE', 'percent': 15})
+        if start < 0 or (end is not None and end < start):
+            raise HTTPError(400, reason='Invalid range')
 
-        self.finish()
+        sequence = None
+        if ObjectId.is_valid(_id):
+            sequence = yield self.sequence_repository.get_sequence(_id, start, end)
+
+        if sequence is None:
+            raise HTTPError(404, reason='Sequence not found')
 
-        dirpath = tempfile.mkdtemp()
-        f = open(os.path.join(dirpath, 'file.fa'), 'wb')
-        f.write(file.body)
-        f.close()
+        self.write_json({'_id': _id, 'start': start, 'end': start + len(sequence), 'sequence': sequence})
 
-        yield self.executor.submit(recreate_idx,
-                                   self.context.config.MONGODB_URL,
-                                   self.context.config.MONGODB_DATABASE,
-                                   f.name,
-                                   self.context.config.INDEX_DIR)
 
-        yield self.job_repository.update({'_id': 'index_job'}, {
-            '$set': {'status': 'RELOADING_INDEX', 'message': 'Reloading index', 'percent': 85}}, process_query=False)
-        SequenceIndex().load(self.context.config.INDEX_DIR, force=True)
-        yield self.job_repository.update({'_id': 'index_job'}, {'$set': {'status': 'DONE', 'percent': 100}},
-                                         process_query=False)
+class SequenceSearchHandler(ApiHandler):
+    """
+    Similarity queries: `global` mode (the default) compares whole sequences,
+    `local` mode finds the query as a fragment of the stored sequences and
+    reports the matching range of each one, `approximate` mode screens the
+    sequences by estimated k-mer similarity (`similarity`, 0.5 by default)
+    with an optional exact re-ranking of the `rerank` most similar ones.
 
-        self.set_status(201)
+    With `timeout_ms` the search stops at the deadline and answers the hits
+    found so far, flagged by the X-Partial-Results header. A search is also
+    stopped when the client disconnects.
+    """
+    stats = None
 
+    def on_connection_close(self):
+        if self.stats is not None:
+            self.stats.cancelled = True
 
-class SequenceQueryHandler(ApiHandler):
     @gen.coroutine
-    def post(self):
-        body = json.loads(self.request.body.decode('utf-8'))
+    def search(self, body):
+        """
+        Runs the query described by the request `body` through the admission
+        control (see :class:`QueryAdmission`)
 
+        :returns the OrderedDict of the matched sequence ids to their hit, best hits first
+        """
         if 'seq' not in body:
             raise HTTPError(400, 'You must have a sequence to query against')
 
         idx = SequenceIndex()
-        found = idx.find({'sequence': body['seq']}, body.get('dist', 100))
-
-        logger.debug('Found {} hits from index'.format(len(found)))
+        if not idx.loaded:
+            raise HTTPError(503, reason='The index is still loading')
+
+        timeout = body.get('timeout_ms')
+        if timeout is not None and (not isinstance(timeout, (int, float)) or timeout <= 0):
+            raise HTTPError(400, reason='timeout_ms must be a positive number')
+
+        # the deadline counts the time spent waiting for admission
+        stats = self.stats = QueryStats(time.perf_counter() + timeout / 1000 if timeout else None)
+        item = {'sequence': body['seq'], 'type': body.get('type'), 'strand': body.get('strand')}
+        mode = body.get('mode', 'global')
+        if mode == 'global':
+            distance = body.get('dist', 100)
+        elif mode == 'local':
+            distance = body.get('dist', len(body['seq']) // 10)
+        else:
+            distance = body.get('dist')
+
+        try:
+            if mode not in ('global', 'local', 'approximate'):
+                raise ValueError('Unknown mode {}, expected global, local or approximate'.format(mode))
+
+            stats.estimated_cost = idx.estimate_cost(item, mode, distance or 0, body.get('rerank', 0))
+            found = yield QueryAdmission().run(stats.estimated_cost, self.run_query, idx, item, mode, distance,
+                                               body, stats)
+        except ValueError as e:
+            raise HTTPError(400, reason=str(e))
+
+        logger.debug('Found {} hits from index {}'.format(len(found), stats.as_dict()))
+        if body.get('debug', False) or self.context.server.debug:
+            self.set_header('X-Index-Stats', json.dumps(stats.as_dict()))
+        if stats.partial:
+            self.set_header('X-Partial-Results', 'true')
         items_dict = OrderedDict()
 
-        for distance, item in found:
-            items_dict[item['name']] = distance
+        for node, hit in found:
+            for name in node['names']:
+                items_dict.setdefault(name, hit)
+
+        return items_dict
+
+    @staticmethod
+    def run_query(idx, item, mode, distance, body, stats):
+        """:returns the (node, hit) pairs of the query"""
+        if mode == 'global':
+            return [(node, {'distance': distance, 'strand': strand})
+                    for distance, node, strand in idx.find(item, distance, stats=stats)]
+
+        if mode == 'local':
+            return [(node, {'distance': distance, 'strand': strand, 'start': start, 'end': end})
+                    for distance, node, strand, start, end in idx.find_local(item, distance, stats=stats)]
+
+        return [(node, {'similarity': similarity, 'strand': strand, 'distance': distance})
+                for similarity, node, strand, distance in
+                idx.find_approximate(item, body.get('similarity', 0.5), body.get('rerank', 0), distance,
+                                     stats=stats)]
+
+
+class SequenceQueryHandler(SequenceSearchHandler):
+    """
+    Runs a similarity query (see :class:`SequenceSearchHandler`) and returns the
+    matched sequences with their hits, with a 206 status when they are partial
+    """
+
+    @gen.coroutine
+    def post(self):
+        body = json.loads(self.request.body.decode('utf-8'))
+        items_dict = yield self.search(body)
+        if self.stats.cancelled:
+            return
 
         seqs = yield self.sequence_repository.find({
             'sequence_id': {'$in': list(items_dict.keys())}
         })
-        seq_dict = {seq['sequence_id']: {**seq, 'distance': items_dict[seq['sequence_id']]} for seq in seqs}
+        seq_dict = {seq['sequence_id']: {**seq, **items_dict[seq['sequence_id']]} for seq in seqs}
+
+        # sequences removed since they were indexed are skipped
+        self.write_json([seq_dict[key] for key in items_dict.keys() if key in seq_dict],
+                        206 if self.stats.partial else 200)
+
+
+class SequenceExportHandler(SequenceSearchHandler):
+    """
+    Streams sequences as FASTA (`format=fasta`, the default) or NDJSON
+    (`format=ndjson`), gzip compressed with `gzip=true`.
+
+    GET exports the sequence collection, filtered by the `_query` argument like
+    the crud api. POST exports the hits of the similarity query in the body
+    (same body as /api/sequence/query), NDJSON records include the hits.
+
+    Documents are read through a batched cursor and written in chunks of about
+    `flush_size` bytes, each flush waits for the client to take the previous
+    one so memory stays constant whatever the size of the export.
+    """
+    formats = {'fasta': 'text/x-fasta', 'ndjson': 'application/x-ndjson'}
+    batch_size = 1000
+    flush_size = 1 << 16
+    line_length = 60
+
+    def prepare(self, *args, **kwargs):
+        super(SequenceExportHandler, self).prepare(*args, **kwargs)
+
+        self.format = self.get_argument('format', 'fasta')
+        if self.format not in self.formats:
+            raise HTTPError(400, reason='Unknown format {}, expected one of {}'.format(
+                self.format, ', '.join(self.formats)))
+
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) \
+            if str2bool(self.get_argument('gzip', 'false')) else None
+        self.buffer, self.buffered, self.closed = [], 0, False
+
+    def on_connection_close(self):
+        super(SequenceExportHandler, self).on_connection_close()
+        self.closed = True
+
+    @gen.coroutine
+    def get(self):
+        query = json.loads(self.get_argument('_query', '{}'))
+        self.sequence_repository.process_query(query)
+
+        self.start_export()
+        cursor = self.sequence_repository.repo.find(query).batch_size(self.batch_size)
+        try:
+            while not self.closed and (yield cursor.fetch_next):
+                yield self.write_document(cursor.next_object())
+        finally:
+            cursor.close()
+
+        yield self.finish_export()
 
-        self.write_json([seq_dict[key] for key in items_dict.keys()])
+    @gen.coroutine
+    def post(self):
+        items_dict = yield self.search(json.loads(self.request.body.decode('utf-8')))
+        names = list(items_dict.keys())
+
+        self.start_export()
+        for start in range(0, len(names), self.batch_size):
+            batch = names[start:start + self.batch_size]
+            documents = yield self.sequence_repository.repo.find({'sequence_id': {'$in': batch}}) \
+                .to_list(None)
+            by_name = {document['sequence_id']: document for document in documents}
+
+            for name in batch:
+                if self.closed:
+                    break
+                if name in by_name:
+                    yield self.write_document(by_name[name], items_dict[name])
+
+        yield self.finish_export()
+
+    def start_export(self):
+        extension = self.format + ('.gz' if self.compressor else '')
+        self.set_header('Content-Type', 'application/gzip' if self.compressor else self.formats[self.format])
+        self.set_header('Content-Disposition', 'attachment; filename="sequences.{}"'.format(extension))
+
+    @gen.coroutine
+    def write_document(self, document, hit=None):
+        self.sequence_repository.on_load(document)
+        if 'chunks' in document:
+            document['sequence'] = yield self.sequence_repository.get_sequence(document['_id'])
+
+        if self.format == 'fasta':
+            data = self.fasta_record(document)
+        else:
+            data = self.serializer.dumps({**document, **(hit or {})}) + b'\n'
+
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.flush_size:
+            yield self.flush_buffer()
+
+    def fasta_record(self, document):
+        sequence_id = document.get('sequence_id', '')
+        description = document.get('tags') or document.get('description') or ''
+        header = description if description.split(None, 1)[:1] == [sequence_id] else \
+            ' '.join(part for part in (sequence_id, description) if part)
+
+        sequence = str(document.get('sequence', ''))
+        lines = [sequence[start:start + self.line_length] for start in range(0, len(sequence), self.line_length)]
+        return '>{}\n{}\n'.format(header, '\n'.join(lines)).encode('utf-8')
+
+    @gen.coroutine
+    def flush_buffer(self):
+        data, self.buffer, self.buffered = b''.join(self.buffer), [], 0
+        if self.compressor:
+            data = self.compressor.compress(data)
+
+        if data and not self.closed:
+            self.write(data)
+            try:
+                yield self.flush()
+            except StreamClosedError:
+                self.closed = True
+
+    @gen.coroutine
+    def finish_export(self):
+        yield self.flush_buffer()
+        if self.closed:
+            return
+
+        if self.compressor:
+            self.write(self.compressor.flush())
+        self.finish()
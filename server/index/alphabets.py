@@ -0,0 +1,101 @@
+import re
+
+GAPS = re.compile(r'[\s\-.*]')
+
+
+def encode(sequence):
+    """
+    Canonical form of a sequence in the index: upper case, without whitespace,
+    gaps and stop codons, so the same sequence written differently maps to the
+    same index node.
+    """
+    return GAPS.sub('', sequence).upper()
+
+
+class Alphabet:
+    """
+    A sequence type with the letters it accepts. Ambiguity codes are accepted
+    as long as at least `min_letters` of the sequence are plain letters: most
+    nucleotide ambiguity codes are amino acids too.
+
+    `seed_size` is the k-mer length of the local search seeds, short enough to
+    hit diverged fragments and long enough to be selective over the alphabet.
+    `sketch_size` is the k-mer length of the MinHash sketches, shorter so the
+    k-mer sets of diverged sequences still overlap.
+    """
+
+    def __init__(self, name, letters, ambiguous='', min_letters=0, complement=None, seed_size=11, sketch_size=8):
+        self.name = name
+        self.letters = letters
+        self.symbols = frozenset(letters + ambiguous)
+        self.min_letters = min_letters
+        self.complement = str.maketrans(complement) if complement else None
+        self.seed_size = seed_size
+        self.sketch_size = sketch_size
+
+    def __repr__(self):
+        return 'Alphabet({})'.format(self.name)
+
+    def accepts(self, encoded):
+        if not self.symbols.issuperset(encoded):
+            return False
+
+        if self.min_letters and encoded:
+            return sum(encoded.count(letter) for letter in self.letters) >= self.min_letters * len(encoded)
+
+        return True
+
+    def reverse_complement(self, encoded):
+        """Raises ValueError for alphabets without strands"""
+        if self.complement is None:
+            raise ValueError('{} sequences have no reverse complement'.format(self.name))
+
+        return encoded.translate(self.complement)[::-1]
+
+
+# IUPAC complements, ambiguity codes included
+DNA_COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N', 'R': 'Y', 'Y': 'R', 'K': 'M', 'M': 'K',
+                  'S': 'S', 'W': 'W', 'B': 'V', 'V': 'B', 'D': 'H', 'H': 'D'}
+RNA_COMPLEMENT = {'A': 'U', 'C': 'G', 'G': 'C', 'U': 'A', 'N': 'N', 'R': 'Y', 'Y': 'R', 'K': 'M', 'M': 'K',
+                  'S': 'S', 'W': 'W', 'B': 'V', 'V': 'B', 'D': 'H', 'H': 'D'}
+
+DNA = Alphabet('dna', 'ACGT', 'NRYKMSWBDHV', min_letters=0.9, complement=DNA_COMPLEMENT)
+RNA = Alphabet('rna', 'ACGU', 'NRYKMSWBDHV', min_letters=0.9, complement=RNA_COMPLEMENT)
+PROTEIN = Alphabet('protein', 'ACDEFGHIKLMNPQRSTVWY', 'BJOUXZ', seed_size=4, sketch_size=3)
+
+# detection order, the first alphabet accepting a sequence wins
+ALPHABETS = [DNA, RNA, PROTEIN]
+ALPHABETS_BY_NAME = {alphabet.name: alphabet for alphabet in ALPHABETS}
+
+
+def get_alphabet(name):
+    """:returns the alphabet called `name`, raises ValueError for an unknown one"""
+    if name not in ALPHABETS_BY_NAME:
+        raise ValueError('Unknown sequence type {}, expected one of {}'.format(
+            name, ', '.join(ALPHABETS_BY_NAME)))
+
+    return ALPHABETS_BY_NAME[name]
+
+
+def find_alphabet(sequence_type):
+    """
+    :returns the alphabet named by the free-form `type` of a sequence document
+    (ex. "DNA"), None for an empty or unknown type
+    """
+    if not sequence_type:
+        return None
+
+    return ALPHABETS_BY_NAME.get(str(sequence_type).strip().lower())
+
+
+def detect(sequence):
+    """
+    :returns the (alphabet, encoded sequence) of `sequence`, sequences no
+    nucleotide alphabet accepts are proteins
+    """
+    encoded = encode(sequence)
+    for alphabet in ALPHABETS:
+        if alphabet.accepts(encoded):
+            return alphabet, encoded
+
+    return PROTEIN, encoded
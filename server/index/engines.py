@@ -0,0 +1,307 @@
+import bisect
+import hashlib
+import random
+from collections import deque
+
+import editdistance
+import pybktree
+
+from server.index.alphabets import encode
+
+
+def sequence_distance(x, y):
+    return editdistance.eval(x['sequence'], y['sequence'])
+
+
+def sequence_hash(sequence):
+    return hashlib.blake2b(sequence.encode('utf-8'), digest_size=16).digest()
+
+
+class IndexEngine:
+    """
+    A shard of the sequence index.
+
+    Nodes are keyed by the content hash of their sequence (`nodes`) and hold the
+    posting list of the ids sharing it, exact duplicates only extend the posting
+    list and never reach the metric structure. `alphabet` holds every letter
+    used by the shard.
+
+    Engines implement :meth:`insert` and :meth:`search` over the distinct nodes,
+    :meth:`optimize` is called once a shard is fully built, before it is saved.
+    A search answers several queries (ex. both strands of a sequence) in one
+    traversal: a subtree is only pruned when it is out of reach of every query.
+
+    `seeds` is the optional :class:`SeedIndex` of the nodes for local search,
+    `lsh` their optional :class:`LSHIndex` for approximate search. `letters`
+    counts the letters of the nodes, for the query cost estimates.
+    """
+    seeds = None
+    lsh = None
+    letters = 0
+    # share of the nodes a metric tree compares even for a tiny radius
+    min_visited = 0.02
+
+    def __init__(self):
+        self.nodes = {}
+        self.alphabet = set()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def add(self, name, sequence):
+        key = sequence_hash(sequence)
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = {'hash': key, 'sequence': sequence, 'names': []}
+            self.alphabet.update(sequence)
+            self.letters += len(sequence)
+            self.insert(node)
+            if self.seeds is not None:
+                self.seeds.add(node)
+            if self.lsh is not None:
+                self.lsh.add(node)
+
+        node['names'].append(name)
+
+    def find(self, sequences, edit_distance, stats):
+        """
+        :returns the (distance, node, query) tuples of the nodes within
+        `edit_distance` of the query sequences, `query` being the position of the
+        sequence matched in `sequences`. The visited nodes, distance evaluations
+        and pruned subtrees are counted into `stats`, searches stop with the
+        matches found so far once `stats.expired()`.
+        """
+        return self.search(sequences, edit_distance, stats)
+
+    def insert(self, node):
+        raise NotImplementedError()
+
+    def search(self, sequences, edit_distance, stats):
+        raise NotImplementedError()
+
+    @property
+    def mean_length(self):
+        if not self.letters and self.nodes:
+            # shards saved before the letters were counted
+            self.letters = sum(len(node['sequence']) for node in self)
+
+        return self.letters / len(self) if self.nodes else 0
+
+    def estimate(self, length, edit_distance):
+        """
+        Expected number of nodes compared by a search for a query of `length`
+        letters: `min_visited` of the nodes plus the ratio of the radius to the
+        mean sequence length, the whole shard past the mean length.
+        """
+        return len(self) * min(1.0, self.min_visited + edit_distance / max(self.mean_length, 1))
+
+    def compare(self, sequences, node, edit_distance, stats, found):
+        """
+        Computes the distances from every query to `node` and collects the matches.
+
+        :returns the list of distances
+        """
+        stats.nodes_visited += 1
+        stats.distance_computations += len(sequences)
+        distances = [editdistance.eval(sequence, node['sequence']) for sequence in sequences]
+        for query, distance in enumerate(distances):
+            if distance <= edit_distance:
+                found.append((distance, node, query))
+
+        return distances
+
+    def optimize(self):
+        pass
+
+
+class BKTreeEngine(IndexEngine):
+    """
+    BK-tree over the nodes, backed by :class:`pybktree.BKTree`.
+    """
+
+    def __init__(self, tree=None):
+        super(BKTreeEngine, self).__init__()
+        self.tree = tree if tree is not None else pybktree.BKTree(sequence_distance)
+
+    @classmethod
+    def from_tree(cls, tree):
+        """
+        Wraps a bare BK-tree saved by an older version: single `name` items get a
+        posting list and the hash map and alphabet are rebuilt. Duplicates already
+        in the tree stay separate nodes until the index is rebuilt, their ids are
+        moved to the first node so the hash lookups see all of them.
+
+        Trees holding sequences that are not in their encoded form (ex. lower
+        case) are rebuilt over the encoded sequences, queries are encoded.
+        """
+        if any(encode(node['sequence']) != node['sequence'] for node in tree):
+            engine = cls()
+            for node in tree:
+                for name in node['names'] if 'names' in node else [node['name']]:
+                    engine.add(name, encode(node['sequence']))
+
+            engine.job_id = getattr(tree, 'job_id', None)
+            return engine
+
+        engine = cls(tree)
+        for node in tree:
+            if 'names' not in node:
+                node['names'] = [node.pop('name')]
+                node['hash'] = sequence_hash(node['sequence'])
+
+            first = engine.nodes.setdefault(node['hash'], node)
+            if first is not node:
+                first['names'].extend(node['names'])
+                node['names'] = []
+
+            engine.alphabet.update(node['sequence'])
+
+        engine.job_id = getattr(tree, 'job_id', None)
+        return engine
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tree.distance_func = sequence_distance
+
+    def insert(self, node):
+        self.tree.add(node)
+
+    def search(self, sequences, edit_distance, stats):
+        """
+        Same traversal as :meth:`pybktree.BKTree.find`, with counters.
+        """
+        found = []
+        if self.tree.tree is None:
+            return found
+
+        candidates = deque([self.tree.tree])
+        while candidates and not stats.expired():
+            candidate, children = candidates.popleft()
+            distances = self.compare(sequences, candidate, edit_distance, stats, found)
+
+            if children:
+                for child_distance, child in children.items():
+                    if any(abs(child_distance - distance) <= edit_distance for distance in distances):
+                        candidates.append(child)
+                    else:
+                        stats.pruned_subtrees += 1
+
+        return found
+
+
+class VPTreeEngine(IndexEngine):
+    """
+    Vantage-point tree over the nodes.
+
+    The tree is built in bulk: added nodes wait in a pending list, searched
+    linearly, until :meth:`optimize` (or a search finding more than
+    `rebuild_ratio` of the nodes pending) rebuilds the tree.
+
+    Inner nodes are (vantage node, median distance, inside, outside) tuples,
+    leaves are lists of at most `leaf_size` nodes.
+    """
+    leaf_size = 16
+    rebuild_ratio = 0.1
+
+    def __init__(self):
+        super(VPTreeEngine, self).__init__()
+        self.root = None
+        self.pending = []
+
+    def insert(self, node):
+        self.pending.append(node)
+
+    def optimize(self):
+        if self.pending:
+            self.root = self.build(list(self.nodes.values()), random.Random(0))
+            self.pending = []
+
+    def build(self, nodes, rng):
+        if len(nodes) <= self.leaf_size:
+            return nodes
+
+        vantage = nodes.pop(rng.randrange(len(nodes)))
+        distances = [editdistance.eval(vantage['sequence'], node['sequence']) for node in nodes]
+        median = sorted(distances)[len(distances) // 2]
+
+        inside = [node for node, distance in zip(nodes, distances) if distance <= median]
+        outside = [node for node, distance in zip(nodes, distances) if distance > median]
+        if not outside:
+            # every node is at the same distance from the vantage point, nothing to split on
+            return nodes + [vantage]
+
+        return vantage, median, self.build(inside, rng), self.build(outside, rng)
+
+    def search(self, sequences, edit_distance, stats):
+        if len(self.pending) > self.rebuild_ratio * len(self.nodes):
+            self.optimize()
+
+        found = []
+        for node in self.pending:
+            if stats.expired():
+                return found
+            self.compare(sequences, node, edit_distance, stats, found)
+
+        candidates = deque([self.root] if self.root is not None else [])
+        while candidates and not stats.expired():
+            candidate = candidates.popleft()
+            if isinstance(candidate, list):
+                for node in candidate:
+                    self.compare(sequences, node, edit_distance, stats, found)
+                continue
+
+            vantage, median, inside, outside = candidate
+            distances = self.compare(sequences, vantage, edit_distance, stats, found)
+
+            # triangle inequality: inside holds d(vantage, x) <= median, outside d(vantage, x) > median
+            if min(distances) - edit_distance <= median:
+                candidates.append(inside)
+            else:
+                stats.pruned_subtrees += 1
+
+            if max(distances) + edit_distance > median:
+                candidates.append(outside)
+            else:
+                stats.pruned_subtrees += 1
+
+        return found
+
+
+class BruteForceEngine(IndexEngine):
+    """
+    Linear scan over the nodes kept sorted by sequence length. The length
+    difference is a lower bound of the edit distance, so only the nodes whose
+    length is within `edit_distance` of the query are compared.
+    """
+
+    def __init__(self):
+        super(BruteForceEngine, self).__init__()
+        self.lengths = []
+        self.sorted_nodes = []
+
+    def insert(self, node):
+        position = bisect.bisect_right(self.lengths, len(node['sequence']))
+        self.lengths.insert(position, len(node['sequence']))
+        self.sorted_nodes.insert(position, node)
+
+    def search(self, sequences, edit_distance, stats):
+        # one length window covering every query, the strands of a sequence have the same length
+        lower = bisect.bisect_left(self.lengths, min(len(sequence) for sequence in sequences) - edit_distance)
+        upper = bisect.bisect_right(self.lengths, max(len(sequence) for sequence in sequences) + edit_distance)
+        stats.pruned_subtrees += len(self.lengths) - (upper - lower)
+
+        found = []
+        for node in self.sorted_nodes[lower:upper]:
+            if stats.expired():
+                break
+            self.compare(sequences, node, edit_distance, stats, found)
+
+        return found
+
+    def estimate(self, length, edit_distance):
+        """Exact number of nodes in the length window of the query"""
+        return bisect.bisect_right(self.lengths, length + edit_distance) - \
+            bisect.bisect_left(self.lengths, length - edit_distance)
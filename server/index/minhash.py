@@ -0,0 +1,95 @@
+import zlib
+from array import array
+
+# added to the values borrowed by empty bins, so they differ from the bin they come from
+DENSIFY = 0x9e3779b1
+
+
+def sketch(sequence, size, kmer_size):
+    """
+    One permutation MinHash sketch of the k-mer set of `sequence`: every k-mer is
+    hashed once (crc32, stable between processes), the hash range is split in
+    `size` bins and each bin keeps its minimum. Empty bins borrow the value of
+    the next non empty bin so short sequences still get comparable sketches.
+
+    :returns an array of `size` 32 bit values
+    """
+    bins = [None] * size
+    for position in range(max(len(sequence) - kmer_size + 1, 1)):
+        value = zlib.crc32(sequence[position:position + kmer_size].encode('utf-8'))
+        index = value * size >> 32
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+
+    for index in range(size):
+        if bins[index] is None:
+            for step in range(1, size):
+                borrowed = bins[(index + step) % size]
+                if borrowed is not None:
+                    bins[index] = (borrowed + step * DENSIFY) & 0xffffffff
+                    break
+
+    return array('I', bins)
+
+
+def similarity(x, y):
+    """Estimated Jaccard similarity of the k-mer sets of two sketches"""
+    return sum(1 for a, b in zip(x, y) if a == b) / len(x)
+
+
+class LSHIndex:
+    """
+    Locality sensitive hashing of the MinHash sketches of the nodes of a shard.
+
+    Sketches are split in `bands` bands of `rows` values, two nodes are candidates
+    when they share at least one band. A pair with similarity s is found with
+    probability 1 - (1 - s^rows)^bands: more bands raise the recall, more rows
+    raise the precision.
+    """
+
+    def __init__(self, bands, rows, kmer_size):
+        self.bands = bands
+        self.rows = rows
+        self.kmer_size = kmer_size
+        self.nodes = []
+        self.sketches = []
+        self.buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def sketch(self, sequence):
+        return sketch(sequence, self.bands * self.rows, self.kmer_size)
+
+    def keys(self, values):
+        return [values[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, node):
+        number, values = len(self.nodes), self.sketch(node['sequence'])
+        self.nodes.append(node)
+        self.sketches.append(values)
+
+        for buckets, key in zip(self.buckets, self.keys(values)):
+            buckets.setdefault(key, []).append(number)
+
+    def candidates(self, sequence, min_similarity, stats):
+        """
+        :returns the (estimated similarity, node) of the nodes sharing a band
+        with `sequence` whose estimated similarity is at least `min_similarity`
+        """
+        values = self.sketch(sequence)
+        numbers = set()
+        for buckets, key in zip(self.buckets, self.keys(values)):
+            stats.hash_lookups += 1
+            numbers.update(buckets.get(key, ()))
+
+        found = []
+        for number in numbers:
+            stats.nodes_visited += 1
+            estimate = similarity(values, self.sketches[number])
+            if estimate >= min_similarity:
+                found.append((estimate, self.nodes[number]))
+            else:
+                stats.pruned_subtrees += 1
+
+        return found
@@ -0,0 +1,121 @@
+from array import array
+
+
+class SeedIndex:
+    """
+    k-mer seed index over the nodes of a shard, used for local similarity search
+    of fragments inside longer sequences.
+
+    Node k-mers are sampled every `stride` positions, postings pack the node
+    number and the offset of the k-mer in one 64 bit integer. Queries look up
+    every one of their k-mers, so any exact match of at least `size + stride - 1`
+    letters yields a seed.
+    """
+    max_postings = 10000
+
+    def __init__(self, size, stride):
+        self.size = size
+        self.stride = stride
+        self.nodes = []
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        number, sequence = len(self.nodes), node['sequence']
+        self.nodes.append(node)
+
+        for offset in range(0, len(sequence) - self.size + 1, self.stride):
+            kmer = sequence[offset:offset + self.size]
+            postings = self.postings.get(kmer)
+            if postings is None:
+                postings = self.postings[kmer] = array('Q')
+            postings.append(number << 32 | offset)
+
+    def seeds(self, sequence, stats):
+        """
+        Looks up every k-mer of `sequence`, k-mers more frequent than
+        `max_postings` (repeats, low complexity regions) are skipped.
+
+        :returns a dict of node number to the list of seed diagonals (node offset - query offset)
+        """
+        diagonals = {}
+        for position in range(len(sequence) - self.size + 1):
+            stats.hash_lookups += 1
+            postings = self.postings.get(sequence[position:position + self.size])
+            if postings is None or len(postings) > self.max_postings:
+                continue
+
+            for posting in postings:
+                diagonals.setdefault(posting >> 32, []).append((posting & 0xffffffff) - position)
+
+        return diagonals
+
+    def candidates(self, sequence, band, stats):
+        """
+        Groups the seeds of each node in clusters of diagonals less than `band` apart.
+
+        :returns the (seed count, node, diagonal) of every cluster, the diagonal
+        being the median of the cluster
+        """
+        found = []
+        for number, diagonals in self.seeds(sequence, stats).items():
+            diagonals.sort()
+            cluster = [diagonals[0]]
+            for diagonal in diagonals[1:]:
+                if diagonal - cluster[-1] > band:
+                    found.append((len(cluster), self.nodes[number], cluster[len(cluster) // 2]))
+                    cluster = []
+                cluster.append(diagonal)
+
+            found.append((len(cluster), self.nodes[number], cluster[len(cluster) // 2]))
+
+        return found
+
+
+def extend(query, subject, diagonal, band, max_distance):
+    """
+    Banded semi-global alignment of the whole `query` against `subject` around
+    `diagonal`: gaps before and after the matched subject range are free. Cells
+    more than `band` away from the diagonal are not computed, the alignment is
+    abandoned as soon as every cell of a row exceeds `max_distance`.
+
+    :returns the (distance, start, end) of the best subject range, None when
+    no range is within `max_distance`
+    """
+    width, length = 2 * band + 1, len(subject)
+    infinity = len(query) + length + 1
+
+    # cell k of row i is the subject position j = base + i + k
+    base = diagonal - band
+    distances = [0 if 0 <= base + k <= length else infinity for k in range(width)]
+    starts = [base + k for k in range(width)]
+
+    for i, letter in enumerate(query, 1):
+        row, row_starts = [infinity] * width, [0] * width
+        for k in range(width):
+            j = base + i + k
+            if j < 0 or j > length:
+                continue
+
+            # match or substitution from (i - 1, j - 1)
+            best, start = (distances[k] + (letter != subject[j - 1]), starts[k]) if j else (infinity, 0)
+            # query letter not in the subject, from (i - 1, j)
+            if k + 1 < width and distances[k + 1] + 1 < best:
+                best, start = distances[k + 1] + 1, starts[k + 1]
+            # subject letter not in the query, from (i, j - 1)
+            if k > 0 and row[k - 1] + 1 < best:
+                best, start = row[k - 1] + 1, row_starts[k - 1]
+
+            row[k], row_starts[k] = best, start
+
+        distances, starts = row, row_starts
+        if min(distances) > max_distance:
+            return None
+
+    k = min(range(width), key=lambda cell: distances[cell])
+    if distances[k] > max_distance:
+        return None
+
+    return distances[k], starts[k], base + len(query) + k
@@ -1,37 +1,603 @@
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import dill
 import editdistance
 import pybktree
 
 import enum
-from server.utils import Singleton
+from server.importer import import_class
+from server.index.alphabets import detect, encode, find_alphabet, get_alphabet
+from server.index.engines import BKTreeEngine, sequence_hash
+from server.index.minhash import LSHIndex
+from server.index.seeds import SeedIndex, extend
+from server.metrics import INDEX_QUERY_DURATION, INDEX_NODES_VISITED, INDEX_DISTANCE_COMPUTATIONS, \
+    INDEX_PRUNED_SUBTREES
+from server.utils import Singleton, logger
+
+DEFAULT_ENGINE = 'server.index.engines.BKTreeEngine'
+
+# stride of the seed indexes built after the first local query of a shard
+LAZY_SEED_STRIDE = 4
+# bands and rows of the LSH indexes built after the first approximate query of a shard
+LAZY_LSH_BANDS, LAZY_LSH_ROWS = 20, 3
+
+# header of the index files holding one pickle per shard
+SHARDS_FORMAT = 'shards/1'
+
+PLUS, MINUS = '+', '-'
+STRANDS = {'plus': (PLUS,), 'minus': (MINUS,), 'both': (PLUS, MINUS)}
+
+
+class QueryStats:
+    """
+    Counters collected while answering a single index query.
+
+    A query stops early, with the hits found so far, once `cancelled` is set
+    (ex. from another thread when the client is gone) or past its `deadline`
+    (a :func:`time.perf_counter` value), its results are then `partial`. They
+    are partial as well when it skipped shards whose seed or LSH index is still
+    being built.
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.cancelled = False
+        self.stopped = False
+        self.partial = False
+        self.strategy = None
+        self.sequence_type = None
+        self.hash_lookups = 0
+        self.nodes_visited = 0
+        self.distance_computations = 0
+        self.pruned_subtrees = 0
+        self.hits = 0
+        self.elapsed = 0
+        self.estimated_cost = 0
+
+    def observe(self):
+        INDEX_QUERY_DURATION.observe(value=self.elapsed)
+        INDEX_NODES_VISITED.observe(value=self.nodes_visited)
+        INDEX_DISTANCE_COMPUTATIONS.observe(value=self.distance_computations)
+        INDEX_PRUNED_SUBTREES.observe(value=self.pruned_subtrees)
+
+    def as_dict(self):
+        return {
+            'strategy': self.strategy,
+            'sequence_type': self.sequence_type,
+            'hash_lookups': self.hash_lookups,
+            'nodes_visited': self.nodes_visited,
+            'distance_computations': self.distance_computations,
+            'pruned_subtrees': self.pruned_subtrees,
+            'hits': self.hits,
+            'elapsed_ms': round(self.elapsed * 1000, 3),
+            'estimated_cost': self.estimated_cost,
+            'partial': self.partial
+        }
+
+    def expired(self):
+        """Checked by the traversals, True once the query must stop"""
+        if not self.stopped and (self.cancelled or (self.deadline is not None and
+                                                    time.perf_counter() > self.deadline)):
+            self.stopped = self.partial = True
+
+        return self.stopped
+
+
+def new_shard(engine=DEFAULT_ENGINE, sequence_type=None, seed_stride=0, lsh_bands=0, lsh_rows=0):
+    """
+    Creates an empty shard with the engine class declared by its full python path,
+    with a seed index sampled every `seed_stride` letters unless it is 0 and an
+    LSH index of `lsh_bands` bands of `lsh_rows` rows unless `lsh_bands` is 0.
+    """
+    shard = import_class(engine)()
+    shard.sequence_type = sequence_type
+    if seed_stride:
+        shard.seeds = SeedIndex(get_alphabet(sequence_type).seed_size, seed_stride)
+    if lsh_bands:
+        shard.lsh = LSHIndex(lsh_bands, lsh_rows, get_alphabet(sequence_type).sketch_size)
+
+    return shard
+
+
+def prepare_shard(shard):
+    """Wraps the bare BK-trees saved by older versions in a :class:`BKTreeEngine`"""
+    if isinstance(shard, pybktree.BKTree):
+        return BKTreeEngine.from_tree(shard)
+
+    return shard
+
+
+def iter_shards(file):
+    """
+    Yields the shards of an open index file one pickle at a time, so a caller
+    can let other threads run between two shards. Older index files hold all
+    their shards, or a single BK-tree, in one pickle.
+    """
+    header = dill.load(file)
+    if isinstance(header, dict) and header.get('format') == SHARDS_FORMAT:
+        for _ in range(header['shards']):
+            yield prepare_shard(dill.load(file))
+    else:
+        for shard in header if isinstance(header, list) else [header]:
+            yield prepare_shard(shard)
+
+
+def load_shards(file_path):
+    """Loads the shards pickled in `file_path`, see :func:`iter_shards`"""
+    with open(file_path, 'rb') as file:
+        return list(iter_shards(file))
+
+
+def group_shards(shards):
+    """
+    Groups shards by sequence type, shards saved by older versions hold every
+    type and are grouped under None.
+    """
+    partitions = {}
+    for shard in shards:
+        partitions.setdefault(getattr(shard, 'sequence_type', None), []).append(shard)
+
+    return partitions
+
+
+def all_shards(partitions):
+    return [shard for shards in partitions.values() for shard in shards]
+
+
+def shard_key(shard):
+    """Identifies a shard read again from idx.pk: its type, job, size and first sequence"""
+    return (getattr(shard, 'sequence_type', None), getattr(shard, 'job_id', None), len(shard),
+            next(iter(shard.nodes), None))
+
+
+def adopt_indexes(shard, previous):
+    """Gives `shard` the seed and LSH indexes built in the background for `previous`, the same shard read before"""
+    for attribute in ('seeds', 'lsh'):
+        index = getattr(previous, attribute)
+        if getattr(shard, attribute) is None and index is not None:
+            index.nodes = [shard.nodes[node['hash']] for node in index.nodes]
+            setattr(shard, attribute, index)
+
+
+def shard_jobs(shard):
+    """:returns the ids of the ingestion jobs whose sequences the shard holds, merged shards hold several"""
+    return getattr(shard, 'job_ids', None) or {getattr(shard, 'job_id', None)}
+
+
+def merge_shards(shards, engine=DEFAULT_ENGINE, **shard_options):
+    """:returns a new `engine` shard (see :func:`new_shard`) holding the sequences of `shards`, all of one type"""
+    merged = new_shard(engine, shards[0].sequence_type, **shard_options)
+    merged.job_ids = set().union(*(shard_jobs(shard) for shard in shards))
+    for shard in shards:
+        for node in shard:
+            for name in node['names']:
+                merged.add(name, node['sequence'])
+
+    return merged
+
+
+def compact_shards(shards, max_shards, engine=DEFAULT_ENGINE, **shard_options):
+    """
+    Merges the smallest shards of the sequence types with more than
+    `max_shards` shards (0 for no limit) into one, so each type is left with
+    `max_shards` shards. Shards saved by older versions, of no type, are kept.
+    """
+    if not max_shards:
+        return shards
+
+    compacted = []
+    for sequence_type, typed in group_shards(shards).items():
+        if sequence_type is None or len(typed) <= max_shards:
+            compacted.extend(typed)
+            continue
+
+        typed = sorted(typed, key=len)
+        merged = len(typed) - max_shards + 1
+        logger.info('Merging {} {} shards of {} sequences'.format(merged, sequence_type,
+                                                                  sum(len(shard) for shard in typed[:merged])))
+        compacted.append(merge_shards(typed[:merged], engine, **shard_options))
+        compacted.extend(typed[merged:])
+
+    return compacted
+
+
+def classify(sequence, sequence_type=None):
+    """
+    :returns the (alphabet, encoded sequence) of `sequence`, the alphabet is
+    detected unless `sequence_type` names it (in any case)
+    """
+    alphabet = find_alphabet(sequence_type)
+    if alphabet is not None:
+        return alphabet, encode(sequence)
+
+    return detect(sequence)
+
+
+def add_sequence(partitions, engine, name, sequence, sequence_type=None, **shard_options):
+    """
+    Adds a sequence to the last shard of the partition of its type, the
+    partition starts with a new `engine` shard built with `shard_options`
+    (see :func:`new_shard`).
+    """
+    alphabet, encoded = classify(sequence, sequence_type)
+    shards = partitions.setdefault(alphabet.name, [])
+    if not shards:
+        shards.append(new_shard(engine, alphabet.name, **shard_options))
+
+    shards[-1].add(name, encoded)
+
+
+def save_shards(shards, file_path):
+    """Saves the shards as a header followed by one pickle per shard"""
+    for shard in shards:
+        shard.optimize()
+
+    with open(file_path, 'wb') as file:
+        dill.dump({'format': SHARDS_FORMAT, 'shards': len(shards)}, file)
+        for shard in shards:
+            dill.dump(shard, file)
+
+
+def parse_strands(item):
+    """:returns the strands to search for the `strand` of the item, raises ValueError for an unknown one"""
+    strands = STRANDS.get(item.get('strand') or 'plus')
+    if strands is None:
+        raise ValueError('Unknown strand {}, expected one of {}'.format(item['strand'], ', '.join(STRANDS)))
+
+    return strands
+
+
+def neighbourhood(sequence, alphabet):
+    """
+    Every sequence at edit distance exactly 1 from `sequence` over `alphabet`.
+    """
+    variants = set()
+    for i in range(len(sequence) + 1):
+        prefix, suffix = sequence[:i], sequence[i:]
+        for letter in alphabet:
+            variants.add(prefix + letter + suffix)
+            if suffix and letter != suffix[0]:
+                variants.add(prefix + letter + suffix[1:])
+
+        if suffix:
+            variants.add(prefix + suffix[1:])
+
+    return variants
+
 
 class SequenceIndex(metaclass=Singleton):
+    """
+    Edit distance index over the stored sequences. The index is made of one
+    or more shards (one per partition built in parallel), each one an
+    :class:`IndexEngine` of the class configured by INDEX_ENGINE when it was
+    built.
+
+    Shards only hold sequences of one type (`partitions` maps the alphabet name
+    to its shards) in their encoded form, queries only search the shards of
+    their own type.
+
+    Queries with distance 0, and distance 1 for sequences up to
+    `neighbourhood_max_length`, are answered with hash lookups only.
+
+    Local queries (:meth:`find_local`) go through the seed index of the shards,
+    built every `seed_stride` letters, and extend the `local_max_candidates`
+    best seeded candidates. Approximate queries (:meth:`find_approximate`) go
+    through the LSH index of the shards, `lsh_bands` bands of `lsh_rows` rows.
+    Shards built without them get them built in a background thread after
+    their first query of the mode, see :meth:`lazy_index`.
+    """
+    local_max_band = 32
+
     def __init__(self):
         self.loaded = False
+        self.load_error = None
+        self.neighbourhood_max_length = 0
+        self.engine = DEFAULT_ENGINE
+        self.seed_stride = 0
+        self.local_max_candidates = 32
+        self.lsh_bands = 0
+        self.lsh_rows = 0
+        self.lazy_builds = {}
+        self.build_lock = threading.Lock()
+        self.build_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lazy-index')
+
+    @property
+    def shard_options(self):
+        """Keyword arguments of :func:`new_shard` for the shards built with the current settings"""
+        return {'seed_stride': self.seed_stride, 'lsh_bands': self.lsh_bands, 'lsh_rows': self.lsh_rows}
 
     def load(self, idx_dir, force=False):
         if self.loaded and not force:
             return
 
+        file_path = os.path.join(idx_dir, 'idx.pk')
+        self.use_shards(idx_dir, load_shards(file_path) if os.path.exists(file_path) else [])
+
+    def use_shards(self, idx_dir, shards):
+        """
+        Serves `shards`, the ones read from the idx.pk of `idx_dir`, in place of
+        the current ones. The seed and LSH indexes built in the background for
+        the current shards are kept for the same shards read again.
+        """
+        previous = {shard_key(shard): shard for shard in all_shards(getattr(self, 'partitions', {}))}
+        for shard in shards:
+            if shard_key(shard) in previous:
+                adopt_indexes(shard, previous[shard_key(shard)])
+
         self.idx_dir = idx_dir
         self.file_path = os.path.join(idx_dir, 'idx.pk')
-        if os.path.exists(self.file_path):
-            with open(self.file_path, 'rb') as file:
-                self.tree = dill.load(file)
-        else:
-            self.tree = pybktree.BKTree(lambda x, y: editdistance.eval(x['sequence'], y['sequence']))
+        self.lazy_builds = {}
+        self.partitions = group_shards(shards)
 
         self.loaded = True
-        self.tree.distance_func = lambda x, y: editdistance.eval(x['sequence'], y['sequence'])
+
+    @property
+    def shards(self):
+        return all_shards(self.partitions)
 
     def save(self, idx_file='idx'):
-        with open(os.path.join(self.idx_dir, '{}.pk'.format(idx_file)), 'wb') as file:
-            dill.dump(self.tree, file)
+        save_shards(self.shards, os.path.join(self.idx_dir, '{}.pk'.format(idx_file)))
 
     def add(self, item):
-        self.tree.add(item)
+        add_sequence(self.partitions, self.engine, item['name'], item['sequence'], item.get('type'),
+                     **self.shard_options)
+
+    def find(self, item, edit_distance=50, stats=None):
+        """
+        Finds the nodes whose sequence is within `edit_distance` of the item's,
+        among the sequences of the same type (`type` of the item, detected when
+        missing or unknown).
+
+        The `strand` of the item (plus, minus or both) selects the orientations
+        of nucleotide queries searched, both strands are searched in the same
+        traversal. Statistics of the query are counted into `stats` (a
+        :class:`QueryStats`) and aggregated into the index metrics.
+
+        :returns a list of (distance, node, strand) tuples ordered by distance,
+        one per node with its closest strand (+ or -), the ids matching a node
+        are in its `names` posting list
+        """
+        stats = stats if stats is not None else QueryStats()
+        start = time.perf_counter()
+
+        alphabet, sequence = classify(item['sequence'], item.get('type'))
+        shards = self.partitions.get(alphabet.name, []) + self.partitions.get(None, [])
+        stats.sequence_type = alphabet.name
+
+        strands = parse_strands(item)
+        queries = [sequence if strand == PLUS else alphabet.reverse_complement(sequence) for strand in strands]
+
+        if edit_distance == 0:
+            stats.strategy = 'exact'
+            found = []
+            for query, query_sequence in enumerate(queries):
+                found.extend(self.find_exact(shards, [query_sequence], 0, query, stats))
+        elif edit_distance == 1 and len(sequence) <= self.neighbourhood_max_length:
+            stats.strategy = 'neighbourhood'
+            letters = set().union(*(shard.alphabet for shard in shards))
+            found = []
+            for query, query_sequence in enumerate(queries):
+                found.extend(self.find_exact(shards, [query_sequence], 0, query, stats))
+                found.extend(self.find_exact(shards, neighbourhood(query_sequence, letters), 1, query, stats))
+        else:
+            stats.strategy = 'tree'
+            found = []
+            for shard in shards:
+                if stats.expired():
+                    break
+                found.extend(shard.find(queries, edit_distance, stats))
+
+        # a node matching both strands is reported once, with the closest one
+        closest = {}
+        for distance, node, query in found:
+            best = closest.get(id(node))
+            if node['names'] and (best is None or (distance, query) < best[:2]):
+                closest[id(node)] = (distance, query, node)
+
+        found = sorted(((distance, node, strands[query]) for distance, query, node in closest.values()),
+                       key=lambda hit: hit[0])
+
+        stats.hits = sum(len(node['names']) for _, node, _ in found)
+        stats.elapsed = time.perf_counter() - start
+        stats.observe()
+        return found
+
+    def estimate_cost(self, item, mode='global', distance=0, rerank=0):
+        """
+        Rough cost of a query in letter comparisons (edit distances run at about
+        3e8 per second), from the length of the query, its radius or re-ranking
+        and the size and mean sequence length of the shards it searches. Shards
+        whose seed or LSH index is still to be built cost nothing, queries skip
+        them while it is built in the background. Raises ValueError like the
+        queries for an unknown strand.
+        """
+        alphabet, sequence = classify(item['sequence'], item.get('type'))
+        shards = self.partitions.get(alphabet.name, []) + self.partitions.get(None, [])
+        length, strands = len(sequence), len(parse_strands(item))
+
+        cost = 0
+        for shard in shards:
+            if mode == 'global':
+                if distance == 0 or (distance == 1 and length <= self.neighbourhood_max_length):
+                    # hash lookups of the query and its neighbourhood
+                    cost += length * (len(shard.alphabet) + 1)
+                else:
+                    cost += shard.estimate(length, distance) * length * shard.mean_length
+            else:
+                cost += length
+
+        if mode == 'local':
+            cost += self.local_max_candidates * length * (2 * min(max(distance, 1), self.local_max_band) + 1)
+        elif mode == 'approximate' and shards:
+            cost += rerank * length * sum(shard.mean_length for shard in shards) / len(shards)
+
+        return int(cost * strands)
+
+    def find_exact(self, shards, sequences, distance, query, stats):
+        found = []
+        for sequence in sequences:
+            key = sequence_hash(sequence)
+            for shard in shards:
+                stats.hash_lookups += 1
+                node = shard.nodes.get(key)
+                if node is not None:
+                    found.append((distance, node, query))
+
+        return found
+
+    def find_local(self, item, max_distance, stats=None):
+        """
+        Finds the nodes holding a range within `max_distance` of the whole
+        sequence of the item (ex. a fragment inside longer records), among the
+        sequences of the same type and on the strands asked like :meth:`find`.
+
+        Candidates come from the k-mer seeds shared with the query, only the
+        `local_max_candidates` ones with the most seeds are extended with a
+        banded alignment around their seed diagonal.
+
+        :returns a list of (distance, node, strand, start, end) tuples ordered by
+        distance, one per node with its best subject range [start, end)
+        """
+        stats = stats if stats is not None else QueryStats()
+        start = time.perf_counter()
+
+        alphabet, sequence = classify(item['sequence'], item.get('type'))
+        shards = self.partitions.get(alphabet.name, []) + self.partitions.get(None, [])
+        stats.sequence_type = alphabet.name
+        stats.strategy = 'local'
+
+        strands = parse_strands(item)
+        queries = [sequence if strand == PLUS else alphabet.reverse_complement(sequence) for strand in strands]
+        band = min(max(max_distance, 1), self.local_max_band)
+
+        candidates = []
+        for shard in shards:
+            if stats.expired():
+                break
+            seeds = self.seed_index(shard, alphabet, stats)
+            if seeds is None:
+                continue
+            for query, query_sequence in enumerate(queries):
+                for count, node, diagonal in seeds.candidates(query_sequence, band, stats):
+                    if node['names']:
+                        candidates.append((count, query, node, diagonal))
+
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        stats.pruned_subtrees += max(len(candidates) - self.local_max_candidates, 0)
+
+        closest = {}
+        for _, query, node, diagonal in candidates[:self.local_max_candidates]:
+            if stats.expired():
+                break
+            stats.nodes_visited += 1
+            stats.distance_computations += 1
+            hit = extend(queries[query], node['sequence'], diagonal, band, max_distance)
+            best = closest.get(id(node))
+            if hit is not None and (best is None or hit[0] < best[0]):
+                closest[id(node)] = (hit[0], node, strands[query], hit[1], hit[2])
+
+        found = sorted(closest.values(), key=lambda hit: hit[0])
+
+        stats.hits = sum(len(hit[1]['names']) for hit in found)
+        stats.elapsed = time.perf_counter() - start
+        stats.observe()
+        return found
+
+    def lazy_index(self, shard, attribute, new_index, stats):
+        """
+        :returns the `attribute` index (seeds or lsh) of the shard, None while
+        it is built: the first query of a shard built without one submits its
+        build, from the empty index returned by `new_index`, to a background
+        thread. Queries skip the shard until the index is complete and their
+        results are partial, so the build is neither part of their cost nor
+        bound by their deadline.
+        """
+        index = getattr(shard, attribute)
+        if index is None:
+            stats.partial = True
+            with self.build_lock:
+                key = (id(shard), attribute)
+                if key not in self.lazy_builds:
+                    self.lazy_builds[key] = self.build_executor.submit(self.build_lazy_index, shard, attribute,
+                                                                       new_index())
+
+        return index
+
+    def build_lazy_index(self, shard, attribute, index):
+        logger.info('Building the {} index of a shard with {} sequences'.format(attribute, len(shard)))
+        for node in shard:
+            index.add(node)
+        # only set once complete, queries skip the shard until then
+        setattr(shard, attribute, index)
+
+    def seed_index(self, shard, alphabet, stats):
+        """:returns the seed index of the shard, None while it is built, see :meth:`lazy_index`"""
+        return self.lazy_index(shard, 'seeds', lambda: SeedIndex(alphabet.seed_size,
+                                                                 self.seed_stride or LAZY_SEED_STRIDE), stats)
+
+    def find_approximate(self, item, min_similarity, rerank=0, max_distance=None, stats=None):
+        """
+        Screens the index for the nodes whose k-mer set is similar to the item's
+        sequence, among the sequences of the same type and on the strands asked
+        like :meth:`find`. Candidates come from the LSH buckets shared with the
+        query and are kept when their estimated Jaccard similarity is at least
+        `min_similarity`.
+
+        When `rerank` is set only the `rerank` most similar candidates are kept,
+        ordered by their exact edit distance and dropped beyond `max_distance`
+        (when given).
+
+        :returns a list of (similarity, node, strand, distance) tuples, distance
+        is None without re-ranking
+        """
+        stats = stats if stats is not None else QueryStats()
+        start = time.perf_counter()
+
+        alphabet, sequence = classify(item['sequence'], item.get('type'))
+        shards = self.partitions.get(alphabet.name, []) + self.partitions.get(None, [])
+        stats.sequence_type = alphabet.name
+        stats.strategy = 'approximate'
+
+        strands = parse_strands(item)
+        queries = [sequence if strand == PLUS else alphabet.reverse_complement(sequence) for strand in strands]
+
+        closest = {}
+        for shard in shards:
+            if stats.expired():
+                break
+            lsh = self.lsh_index(shard, alphabet, stats)
+            if lsh is None:
+                continue
+            for query, query_sequence in enumerate(queries):
+                for estimate, node in lsh.candidates(query_sequence, min_similarity, stats):
+                    best = closest.get(id(node))
+                    if node['names'] and (best is None or estimate > best[0]):
+                        closest[id(node)] = (estimate, node, strands[query], None)
+
+        found = sorted(closest.values(), key=lambda hit: hit[0], reverse=True)
+
+        if rerank:
+            reranked = []
+            for estimate, node, strand, _ in found[:rerank]:
+                if stats.expired():
+                    break
+                stats.distance_computations += 1
+                distance = editdistance.eval(queries[strands.index(strand)], node['sequence'])
+                if max_distance is None or distance <= max_distance:
+                    reranked.append((estimate, node, strand, distance))
+
+            found = sorted(reranked, key=lambda hit: hit[3])
+
+        stats.hits = sum(len(hit[1]['names']) for hit in found)
+        stats.elapsed = time.perf_counter() - start
+        stats.observe()
+        return found
 
-    def find(self, item, edit_distance=50):
-        return self.tree.find(item, edit_distance)
+    def lsh_index(self, shard, alphabet, stats):
+        """:returns the LSH index of the shard, None while it is built, see :meth:`lazy_index`"""
+        return self.lazy_index(shard, 'lsh', lambda: LSHIndex(self.lsh_bands or LAZY_LSH_BANDS,
+                                                              self.lsh_rows or LAZY_LSH_ROWS, alphabet.sketch_size),
+                               stats)
@@ -0,0 +1,513 @@
+import glob
+import hashlib
+import os
+import threading
+import traceback
+from concurrent.futures.process import ProcessPoolExecutor, BrokenProcessPool
+from datetime import datetime, timedelta
+
+import dill
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition, Lock
+
+from server.index.alphabets import detect
+from server.sequence_codecs import get_codec, chunk_documents
+from server.index.sequence_index import SequenceIndex, DEFAULT_ENGINE, load_shards, save_shards, prepare_shard, \
+    group_shards, all_shards, add_sequence, compact_shards, shard_jobs
+from server.utils import Singleton, logger
+
+INSERT_BATCH_SIZE = 1000
+PROGRESS_EVERY = 1000
+POLL_INTERVAL = 5
+DUPLICATE_KEY = 11000
+MAX_ATTEMPTS = 3
+
+QUEUED, DONE, FAILED = 'QUEUED', 'DONE', 'FAILED'
+FINISHED_STATUSES = [DONE, FAILED]
+
+FAILED_JOB = {'$set': {'status': FAILED, 'message': 'Failed job', 'percent': 100}}
+
+DEFAULT_CODEC = 'server.sequence_codecs.PlainCodec'
+DEFAULT_CHUNK_SIZE = 262144
+
+_index_executors = {}
+
+
+def get_index_executor(workers, reset=False):
+    """
+    Process pool shared by the partition builds, `workers` <= 0 means one per cpu.
+    `reset` replaces a pool broken by a dead worker process.
+    """
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    if reset and workers in _index_executors:
+        _index_executors.pop(workers).shutdown(wait=False)
+
+    if workers not in _index_executors:
+        _index_executors[workers] = ProcessPoolExecutor(max_workers=workers)
+
+    return workers, _index_executors[workers]
+
+
+def is_broken(executor):
+    """True once a worker process of the pool died, it then refuses new tasks"""
+    try:
+        executor.submit(int)
+    except BrokenProcessPool:
+        return True
+
+    return False
+
+
+def partition_path(idx_dir, job_id, partition):
+    return os.path.join(idx_dir, 'idx_new.{}.{}.pk'.format(job_id, partition))
+
+
+def read_fasta(file, offset=0):
+    """
+    Reads the FASTA records of a file opened in binary mode starting at byte `offset`.
+
+    Yields (next_offset, sequence_id, description, sequence) tuples where
+    `next_offset` is the byte offset of the following record, so reading can
+    be resumed from any record boundary.
+    """
+    file.seek(offset)
+    position, header, chunks = offset, None, []
+
+    def record():
+        description = header.decode('utf-8')
+        return description.split(None, 1)[0] if description else '', description, \
+            b''.join(chunks).decode('utf-8')
+
+    for line in iter(file.readline, b''):
+        if line.startswith(b'>'):
+            if header is not None:
+                yield (position,) + record()
+            header, chunks = line[1:].strip(), []
+        elif header is not None:
+            chunks.append(line.strip())
+        position += len(line)
+
+    if header is not None:
+        yield (position,) + record()
+
+
+def insert_batch(collection, batch):
+    """
+    Inserts a batch of documents ignoring the ones already inserted by a previous
+    run of the same job (unique indexes on job_id and record, sequence and n).
+    """
+    try:
+        collection.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        if e.details.get('writeConcernErrors') or \
+                any(error['code'] != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+            raise
+
+
+def record_id(job_id, record):
+    """
+    Id of the document of a record, the same in every run of the job so the
+    chunks of a resumed job are not inserted twice
+    """
+    return ObjectId(hashlib.blake2b('{}:{}'.format(job_id, record).encode('utf-8'), digest_size=12).digest())
+
+
+def insert_sequences(db_url, db, job_id, file_path, codec=DEFAULT_CODEC, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Inserts every record of the FASTA file in the `sequence` collection in batches,
+    sequences are stored with the `codec` class. Sequences longer than `chunk_size`
+    are split in the `sequence_chunk` collection, inserted before their document.
+
+    After each batch the byte offset of the next record is committed in the
+    `checkpoint` field of the job, a resumed job continues from there.
+
+    :returns the number of inserted sequences
+    """
+    pymongo_client = MongoClient(db_url, connectTimeoutMS=2)
+    db = pymongo_client[db]
+
+    job = db.job.find_one({'_id': job_id}) or {}
+    checkpoint = job.get('checkpoint') or {}
+    if checkpoint.get('inserted'):
+        return checkpoint['records']
+
+    offset, size = checkpoint.get('offset', 0), checkpoint.get('records', 0)
+    db.job.update_one({'_id': job_id}, {'$set': {
+        'status': 'STARTING',
+        'file': file_path,
+        'current_seq': size,
+        'message': 'Resuming indexing job from record {}'.format(size) if size else 'Started indexing job'
+    }}, upsert=True)
+
+    codec, batch = get_codec(codec), []
+    with open(file_path, 'rb') as file:
+        for offset, sequence_id, description, sequence in read_fasta(file, offset):
+            document = {
+                'sequence_id': sequence_id,
+                'type': detect(sequence)[0].name,
+                'tags': description,
+                'sequence_size': len(sequence),
+                'last_modified_date': datetime.now(),
+                'job_id': job_id,
+                'record': size + len(batch)
+            }
+            if len(sequence) > chunk_size:
+                document['_id'] = record_id(job_id, document['record'])
+                chunks = chunk_documents(document['_id'], sequence, chunk_size, codec)
+                insert_batch(db.sequence_chunk, chunks)
+                document['chunks'] = {'size': chunk_size, 'count': len(chunks)}
+            else:
+                document['sequence'] = codec.encode(sequence)
+            batch.append(document)
+
+            if len(batch) == INSERT_BATCH_SIZE:
+                insert_batch(db.sequence, batch)
+                size += len(batch)
+                db.job.update_one({'_id': job_id}, {'$set': {
+                    'checkpoint': {'offset': offset, 'records': size, 'last_record': sequence_id},
+                    'current_seq': size, 'message': 'Inserted {} sequences'.format(size)}})
+                batch = []
+
+    if batch:
+        insert_batch(db.sequence, batch)
+        size += len(batch)
+
+    db.job.update_one({'_id': job_id}, {'$set': {
+        'checkpoint': {'offset': offset, 'records': size, 'inserted': True},
+        'status': 'INDEXING', 'no_seqs': size, 'current_seq': size, 'percent': 50,
+        'message': 'Inserted {} sequences, building the index'.format(size)}})
+    return size
+
+
+def save_checkpoint(path, records, by_type):
+    with open(path + '.tmp', 'wb') as file:
+        dill.dump({'records': records, 'shards': all_shards(by_type)}, file)
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path):
+    with open(path, 'rb') as file:
+        checkpoint = dill.load(file)
+
+    shards = checkpoint['shards'] if 'shards' in checkpoint else [checkpoint['tree']]
+    return checkpoint['records'], group_shards([prepare_shard(shard) for shard in shards])
+
+
+def build_partition(db_url, db, job_id, file_path, idx_dir, partition, partitions, size,
+                    checkpoint_every=0, engine=DEFAULT_ENGINE, shard_options=None):
+    """
+    Builds the shards (one per sequence type) with the `engine` class over the
+    FASTA records that fall in `partition` (round robin on the record position)
+    and saves them next to the index. `shard_options` are the keyword arguments
+    of :func:`new_shard` (seed and LSH indexes).
+    Progress is reported in the `workers.<partition>` field of the job document.
+
+    Every `checkpoint_every` records the partial shards are saved with the number
+    of records they hold, a resumed build starts from the last saved shards.
+    """
+    pymongo_client = MongoClient(db_url, connectTimeoutMS=2)
+    db = pymongo_client[db]
+
+    field = 'workers.{}'.format(partition)
+    path = partition_path(idx_dir, job_id, partition)
+    checkpoint_path = path + '.ckpt'
+
+    job = db.job.find_one({'_id': job_id}, {'workers': 1}) or {}
+    state = (job.get('workers') or {}).get(str(partition)) or {}
+    if state.get('status') == DONE and os.path.exists(path):
+        return state['current_seq']
+
+    if os.path.exists(checkpoint_path):
+        current, by_type = load_checkpoint(checkpoint_path)
+    else:
+        current, by_type = 0, {}
+
+    total = size // partitions + (1 if partition < size % partitions else 0)
+    progress = {'partition': partition, 'status': 'INDEXING', 'current_seq': current, 'no_seqs': total,
+                'percent': round(current / total * 100) if total else 0}
+    db.job.update_one({'_id': job_id}, {'$set': {field: progress}})
+
+    seen = 0
+    with open(file_path, 'rb') as file:
+        for index, (_, sequence_id, _, sequence) in enumerate(read_fasta(file)):
+            if index % partitions != partition:
+                continue
+
+            seen += 1
+            if seen <= current:
+                continue
+
+            add_sequence(by_type, engine, sequence_id, sequence, **(shard_options or {}))
+            current += 1
+            if checkpoint_every and current % checkpoint_every == 0:
+                save_checkpoint(checkpoint_path, current, by_type)
+
+            if current % PROGRESS_EVERY == 0:
+                db.job.update_one({'_id': job_id}, {'$set': {
+                    field + '.current_seq': current, field + '.percent': round(current / total * 100)}})
+
+    shards = all_shards(by_type)
+    for shard in shards:
+        shard.job_id = job_id
+    save_shards(shards, path)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    db.job.update_one({'_id': job_id}, {'$set': {
+        field + '.status': DONE, field + '.current_seq': current, field + '.percent': 100}})
+    return current
+
+
+def merge_partitions(db_url, db, job_id, idx_dir, partitions, max_shards=0, engine=DEFAULT_ENGINE,
+                     shard_options=None):
+    """
+    Appends the partition shards of the job to idx.pk, the smallest shards of a
+    type with more than `max_shards` shards are rebuilt into one `engine` shard
+    (see :func:`compact_shards`).
+    Shards are tagged with their job id so a resumed job never merges twice.
+    Merges must not run concurrently, the queue runs them in a single process.
+    """
+    pymongo_client = MongoClient(db_url, connectTimeoutMS=2)
+    db = pymongo_client[db]
+
+    db.job.update_one({'_id': job_id}, {
+        '$set': {'status': 'FINISHED_INSERT', 'message': 'Saving index to disk... this may take a while',
+                 'percent': 70}})
+
+    idx_path = os.path.join(idx_dir, 'idx.pk')
+    shards = [shard for shard in load_shards(idx_path) if len(shard)] if os.path.exists(idx_path) else []
+
+    if not any(job_id in shard_jobs(shard) for shard in shards):
+        for partition in range(partitions):
+            shards.extend(load_shards(partition_path(idx_dir, job_id, partition)))
+
+        shards = compact_shards(shards, max_shards, engine, **(shard_options or {}))
+        save_shards(shards, os.path.join(idx_dir, 'idx_new.pk'))
+        os.replace(os.path.join(idx_dir, 'idx_new.pk'), idx_path)
+
+    for partition in range(partitions):
+        if os.path.exists(partition_path(idx_dir, job_id, partition)):
+            os.remove(partition_path(idx_dir, job_id, partition))
+
+    db.job.update_one({'_id': job_id},
+                      {'$set': {'status': 'FINISHED_SAVE', 'message': 'Saved index to disk', 'percent': 80}})
+
+
+def recreate_idx(db_url, db, job_id, file_path, idx_dir, partitions=1, checkpoint_every=0, engine=DEFAULT_ENGINE,
+                 shard_options=None, codec=DEFAULT_CODEC, chunk_size=DEFAULT_CHUNK_SIZE, max_shards=0):
+    """
+    Runs the whole ingestion of a job in the calling process: inserts the FASTA
+    records and builds the index with `partitions` worker processes.
+    Calling it again for an interrupted job resumes it from its checkpoints.
+    """
+    try:
+        size = insert_sequences(db_url, db, job_id, file_path, codec, chunk_size)
+        if partitions > 1:
+            with ProcessPoolExecutor(max_workers=partitions) as executor:
+                futures = [executor.submit(build_partition, db_url, db, job_id, file_path, idx_dir, partition,
+                                           partitions, size, checkpoint_every, engine, shard_options)
+                           for partition in range(partitions)]
+                for future in futures:
+                    future.result()
+        else:
+            build_partition(db_url, db, job_id, file_path, idx_dir, 0, 1, size, checkpoint_every, engine,
+                            shard_options)
+        merge_partitions(db_url, db, job_id, idx_dir, partitions, max_shards, engine, shard_options)
+    except:
+        print(traceback.format_exc())
+        MongoClient(db_url, connectTimeoutMS=2)[db].job.update_one({'_id': job_id}, FAILED_JOB)
+
+
+class IngestQueue(metaclass=Singleton):
+    """
+    Queue of ingestion jobs stored in the `job` collection.
+
+    Jobs are claimed atomically from mongo by INGEST_WORKERS worker coroutines, the
+    insert phase of each job runs in its own process, the partition builds share
+    the index build pool and merges into idx.pk are serialized in a single process.
+    """
+
+    def __init__(self):
+        self.started = False
+        self.condition = Condition()
+        self.reload_lock = Lock()
+        self.reset_lock = threading.Lock()
+
+    def start(self, context):
+        if self.started:
+            return
+
+        self.started = True
+        self.context = context
+        self.config = context.config
+        self.jobs = context.repositories['job']
+
+        self.workers = max(self.config.INGEST_WORKERS, 1)
+        self.create_executors()
+
+        self.upload_dir = self.config.UPLOAD_DIR or os.path.join(self.config.INDEX_DIR, 'uploads')
+        os.makedirs(self.upload_dir, exist_ok=True)
+
+        IOLoop.current().spawn_callback(self.run)
+
+    def create_executors(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.merge_executor = ProcessPoolExecutor(max_workers=1)
+        self.partitions, self.index_executor = get_index_executor(self.config.INDEX_BUILD_WORKERS)
+
+    def reset_executors(self):
+        """
+        Replaces the current pools broken by a dead worker process. The other
+        jobs running on a broken pool fail as well and are queued again, the
+        pools are then already replaced and left alone.
+        """
+        with self.reset_lock:
+            broken = [executor for executor in (self.executor, self.merge_executor, self.index_executor)
+                      if is_broken(executor)]
+            for executor in broken:
+                executor.shutdown(wait=False)
+
+            if self.executor in broken:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            if self.merge_executor in broken:
+                self.merge_executor = ProcessPoolExecutor(max_workers=1)
+            if self.index_executor in broken:
+                self.partitions, self.index_executor = get_index_executor(self.config.INDEX_BUILD_WORKERS, True)
+
+    @gen.coroutine
+    def run(self):
+        # jobs reload the index when they finish, never while it is being loaded
+        yield self.context.index_loaded.wait()
+        # resumed jobs rely on the unique (job_id, record) index not to insert their records twice
+        yield self.context.db.ready.wait()
+        yield self.recover()
+
+        for _ in range(self.workers):
+            IOLoop.current().spawn_callback(self.worker)
+
+    def remove_checkpoints(self, job_id):
+        for path in glob.glob(os.path.join(self.config.INDEX_DIR, 'idx_new.{}.*'.format(job_id))):
+            os.remove(path)
+
+    @gen.coroutine
+    def recover(self):
+        """
+        Applies the JOB_RECOVERY policy to the jobs left running by a previous
+        server process: `resume` queues them again to continue from their last
+        checkpoint, `requeue` starts them over and `fail` marks them as failed.
+        """
+        policy = self.config.JOB_RECOVERY
+        jobs = yield self.jobs.find({'status': {'$nin': FINISHED_STATUSES + [QUEUED]}}, process_query=False)
+
+        for job in jobs:
+            if policy == 'resume':
+                update = {'$set': {'status': QUEUED, 'message': 'Resuming from the last checkpoint after restart'}}
+            elif policy == 'requeue':
+                self.remove_checkpoints(job['_id'])
+                update = {'$set': {'status': QUEUED, 'percent': 0, 'message': 'Requeued after restart'},
+                          '$unset': {'workers': '', 'checkpoint': '', 'partitions': ''}}
+            else:
+                update = {'$set': {'status': FAILED, 'percent': 100, 'message': 'Interrupted by a server restart'}}
+
+            yield self.jobs.update({'_id': job['_id']}, update, process_query=False)
+
+        if jobs:
+            logger.info('Recovered {} interrupted jobs with policy {}'.format(len(jobs), policy))
+
+    @gen.coroutine
+    def retry(self, job_id):
+        """
+        Queues a failed job again, it resumes from its last checkpoint.
+        """
+        job = yield self.jobs.find_and_update(
+            {'_id': job_id, 'status': FAILED},
+            {'$set': {'status': QUEUED, 'attempts': 0, 'message': 'Resuming from the last checkpoint'}},
+            update_fields=False)
+
+        if job:
+            self.condition.notify()
+
+        return job
+
+    @gen.coroutine
+    def enqueue(self, filename, body):
+        job_id = ObjectId()
+        file_path = os.path.join(self.upload_dir, '{}.fa'.format(job_id))
+        with open(file_path, 'wb') as file:
+            file.write(body)
+
+        job = yield self.jobs.save({
+            '_id': job_id,
+            'status': QUEUED,
+            'file': file_path,
+            'filename': filename,
+            'percent': 0,
+            'message': 'Waiting for a free worker',
+            'created_date': datetime.now()
+        })
+
+        self.condition.notify()
+        return job
+
+    @gen.coroutine
+    def worker(self):
+        while True:
+            job = yield self.jobs.find_and_update(
+                {'status': QUEUED}, {'$set': {'status': 'STARTING', 'started_date': datetime.now()},
+                                     '$inc': {'attempts': 1}},
+                sort=[('created_date', 1)], process_query=False, update_fields=False)
+
+            if not job:
+                yield self.condition.wait(timeout=timedelta(seconds=POLL_INTERVAL))
+                continue
+
+            try:
+                yield self.process(job)
+            except BrokenProcessPool:
+                # a worker process died (ex. killed for memory), the job resumes from its checkpoints
+                logger.error('Worker process died running job {}'.format(job['_id']))
+                self.reset_executors()
+
+                if job.get('attempts', 1) < MAX_ATTEMPTS:
+                    update = {'$set': {'status': QUEUED, 'message': 'Worker died, resuming from the last checkpoint'}}
+                    yield self.jobs.update({'_id': job['_id']}, update, process_query=False)
+                else:
+                    yield self.jobs.update({'_id': job['_id']}, FAILED_JOB, process_query=False)
+            except Exception:
+                logger.error('Indexing job {} failed: {}'.format(job['_id'], traceback.format_exc()))
+                yield self.jobs.update({'_id': job['_id']}, FAILED_JOB, process_query=False)
+
+    @gen.coroutine
+    def process(self, job):
+        job_id, file_path = job['_id'], job['file']
+        db_url, db, idx_dir = self.config.MONGODB_URL, self.config.MONGODB_DATABASE, self.config.INDEX_DIR
+        checkpoint_every, engine = self.config.INGEST_CHECKPOINT_EVERY, self.config.INDEX_ENGINE
+        shard_options = SequenceIndex().shard_options
+
+        # a resumed job keeps the partitioning of its checkpoints
+        partitions = job.get('partitions') or self.partitions
+        yield self.jobs.update({'_id': job_id}, {'$set': {'partitions': partitions}}, process_query=False)
+
+        size = yield self.executor.submit(insert_sequences, db_url, db, job_id, file_path,
+                                          self.config.SEQUENCE_CODEC, self.config.SEQUENCE_CHUNK_SIZE)
+        # a list of executor futures would be resolved from the executor threads, without waking the IOLoop
+        yield [IOLoop.current().run_in_executor(self.index_executor, build_partition, db_url, db, job_id, file_path,
+                                                idx_dir, partition, partitions, size, checkpoint_every, engine,
+                                                shard_options)
+               for partition in range(partitions)]
+        yield self.merge_executor.submit(merge_partitions, db_url, db, job_id, idx_dir, partitions,
+                                         self.config.INDEX_MAX_SHARDS, engine, shard_options)
+
+        yield self.jobs.update({'_id': job_id}, {
+            '$set': {'status': 'RELOADING_INDEX', 'message': 'Reloading index', 'percent': 85}}, process_query=False)
+        # one reload at a time, so the last one to finish reads the latest idx.pk
+        with (yield self.reload_lock.acquire()):
+            yield self.context.read_index()
+        yield self.jobs.update({'_id': job_id}, {'$set': {'status': DONE, 'percent': 100, 'message': 'Done'}},
+                               process_query=False)
+
+        os.remove(file_path)
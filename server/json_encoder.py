@@ -3,6 +3,14 @@ import json
 
 from bson import ObjectId
 
+from server.importer import import_class
+from server.sequence_codecs import LazySequence
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class Encoder(json.JSONEncoder):
     def default(self, o):
@@ -10,6 +18,62 @@ class Encoder(json.JSONEncoder):
             return str(o)
         if isinstance(o, datetime.datetime):
             return str(o)
+        if isinstance(o, LazySequence):
+            return o.value
 
         obj = json.JSONEncoder.default(self, o)
         return obj
+
+
+class Serializer:
+    '''
+    Base serializer used by the api handlers to encode response bodies.
+    Subclasses must return the encoded document as bytes.
+    '''
+
+    def dumps(self, obj):
+        raise NotImplementedError()
+
+
+class StdlibSerializer(Serializer):
+    '''Serializer based on the stdlib json module and the :class:`Encoder` above'''
+
+    def dumps(self, obj):
+        return json.dumps(obj, cls=Encoder).encode('utf-8')
+
+
+def _orjson_default(o):
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, datetime.datetime):
+        return str(o)
+    if isinstance(o, LazySequence):
+        return o.value
+
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
+
+class OrjsonSerializer(Serializer):
+    '''
+    Serializer based on orjson, ObjectId, LazySequence and datetime objects go
+    through the python default() callback, datetimes keep the str() format of
+    :class:`Encoder` the frontend displays.
+    '''
+
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else None
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, default=_orjson_default, option=self.option)
+
+
+FastSerializer = OrjsonSerializer if orjson else StdlibSerializer
+
+_serializers = {}
+
+
+def get_serializer(name):
+    '''Returns a shared instance of the serializer class declared by its full python path'''
+    if name not in _serializers:
+        _serializers[name] = import_class(name)()
+
+    return _serializers[name]
@@ -0,0 +1,176 @@
+import bisect
+import threading
+
+from pymongo import monitoring
+
+from server.utils import Singleton
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''
+    Base class for in-process metrics. Each metric keeps one series per label
+    values tuple, updates are guarded by a lock because pymongo listeners are
+    called from the motor executor threads.
+    '''
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+
+        with self.lock:
+            for values, series in sorted(self.series.items()):
+                lines.extend(self.expose_series(values, series))
+
+        return lines
+
+    def expose_series(self, values, series):
+        return ['{}{} {}'.format(self.name, _format_labels(self.labels, values), _format_value(series))]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *values, amount=1):
+        with self.lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *values, amount=1):
+        with self.lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+    def dec(self, *values, amount=1):
+        self.inc(*values, amount=-amount)
+
+    def set(self, *values, value=0):
+        with self.lock:
+            self.series[values] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, *values, value):
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [[0] * len(self.buckets), 0, 0]
+
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose_series(self, values, series):
+        counts, total, count = series
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{} {}'.format(self.name,
+                                                 _format_labels(self.labels + ('le',), values + (_format_value(bound),)),
+                                                 cumulative))
+
+        labels = _format_labels(self.labels, values)
+        lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+        lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+
+class MetricsRegistry(metaclass=Singleton):
+    '''Process wide registry of metrics exposed in the prometheus text format'''
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def expose(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].expose())
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+REQUEST_LATENCY = registry.histogram('http_request_duration_seconds', 'Request latency by handler and method',
+                                     ('handler', 'method'))
+REQUEST_STATUS = registry.counter('http_requests_total', 'Finished requests by handler, method and status',
+                                  ('handler', 'method', 'status'))
+REQUESTS_IN_FLIGHT = registry.gauge('http_requests_in_flight', 'Requests currently being served', ('handler',))
+
+MONGO_LATENCY = registry.histogram('mongo_command_duration_seconds', 'Mongo command latency by command name',
+                                   ('command', 'status'))
+
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+INDEX_QUERY_DURATION = registry.histogram('index_query_duration_seconds', 'Sequence index query wall time')
+INDEX_NODES_VISITED = registry.histogram('index_query_nodes_visited', 'Index nodes visited per query',
+                                         buckets=COUNT_BUCKETS)
+INDEX_DISTANCE_COMPUTATIONS = registry.histogram('index_query_distance_computations',
+                                                 'Edit distance evaluations per query', buckets=COUNT_BUCKETS)
+INDEX_PRUNED_SUBTREES = registry.histogram('index_query_pruned_subtrees', 'Subtrees pruned per query',
+                                           buckets=COUNT_BUCKETS)
+QUERY_ADMISSIONS = registry.counter('index_query_admissions_total',
+                                    'Similarity queries by admission decision: inline, heavy, rejected or timeout',
+                                    ('decision',))
+HEAVY_QUERIES_IN_FLIGHT = registry.gauge('index_heavy_queries_in_flight', 'Heavy similarity queries running')
+DOCUMENT_CACHE_LOOKUPS = registry.counter('document_cache_lookups_total',
+                                          'find_one lookups by _id served by the document cache (hit) or mongo (miss)',
+                                          ('collection', 'result'))
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    '''Pymongo command listener that records the duration of every mongo command'''
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_LATENCY.observe(event.command_name, 'success', value=event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_LATENCY.observe(event.command_name, 'failure', value=event.duration_micros / 1e6)
+
@@ -8,8 +8,13 @@ import tornado.gen as gen
 from bson import ObjectId
 from cerberus import Validator
 from tornado import web
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 from tornado.web import HTTPError
 
+from server.metrics import DOCUMENT_CACHE_LOOKUPS
+from server.model.cache import get_document_cache
+
 
 class ValidatorError(web.HTTPError):
     def __init__(self, message, validator_error_list):
@@ -28,6 +33,26 @@ class ValidatorError(web.HTTPError):
             return message
 
 
+_validators = {}
+
+
+def get_validator(schema, allow_unknown=False, purge_unknown=False):
+    """
+    Returns a cerberus Validator compiled for the given schema and options.
+
+    Validators are compiled once per (schema, allow_unknown, purge_unknown) and
+    reused, schemas are keyed by identity so they must not be mutated after
+    their first use.
+    """
+    key = (id(schema), allow_unknown, purge_unknown)
+    cached = _validators.get(key)
+    if cached is None or cached[0] is not schema:
+        cached = (schema, Validator(schema, allow_unknown=allow_unknown, purge_unknown=purge_unknown))
+        _validators[key] = cached
+
+    return cached[1]
+
+
 class BaseModel(object):
     """
     Base Model class that accomplishes translation from
@@ -59,13 +84,38 @@ class BaseModel(object):
 
     def validate(self, schema=None, allow_unknown=False, purge_unknown=False):
         schema = schema if schema else self.DefaultSchema
-        validator = Validator(schema, allow_unknown=allow_unknown, purge_unknown=purge_unknown)
+        validator = get_validator(schema, allow_unknown, purge_unknown)
 
         is_valid = validator.validate(self.__dict__)
         if not is_valid:
             raise ValidatorError('Validation failed', validator.errors)
 
-        return validator.normalized(self.__dict__)
+        # validate() already normalized the document, no need for a second pass
+        return validator.document
+
+    @classmethod
+    def validate_many(cls, dictionaries, schema=None, allow_unknown=False, purge_unknown=False):
+        """
+        Validates a list of objects with a single compiled validator.
+
+        :returns the list of normalized objects
+        :raises ValidatorError with the errors keyed by the index of each invalid object
+        """
+        schema = schema if schema else cls.DefaultSchema
+        validator = get_validator(schema, allow_unknown, purge_unknown)
+
+        normalized, errors = [], {}
+        for index, dictionary in enumerate(dictionaries):
+            if validator.validate(dictionary):
+                normalized.append(validator.document)
+            else:
+                errors[index] = validator.errors
+
+        if errors:
+            raise ValidatorError('Validation failed for {} of {} objects'.format(len(errors), len(dictionaries)),
+                                 errors)
+
+        return normalized
 
     @classmethod
     def return_model_dict(cls, dictionary, validate=False, principal=None, update_fields=True,
@@ -84,15 +134,18 @@ class BaseModel(object):
         if not json_object:
             return None
 
-        if multi:
+        loaded = json.loads(json_object)
+        if multi or isinstance(loaded, list):
+            if validate:
+                loaded = cls.validate_many(loaded, schema=schema, allow_unknown=allow_unknown,
+                                           purge_unknown=purge_unknown)
+
             return list(map(
-                lambda dictionary: cls.return_model_dict(dictionary, validate=validate,
-                                                         principal=principal, update_fields=update_fields,
-                                                         schema=schema, allow_unknown=allow_unknown,
-                                                         purge_unknown=purge_unknown),
-                json.loads(json_object)))
+                lambda dictionary: cls.return_model_dict(dictionary, principal=principal,
+                                                         update_fields=update_fields),
+                loaded))
 
-        return cls.return_model_dict(json.loads(json_object), validate=validate,
+        return cls.return_model_dict(loaded, validate=validate,
                                      principal=principal, update_fields=update_fields, schema=schema,
                                      allow_unknown=allow_unknown, purge_unknown=purge_unknown)
 
@@ -125,6 +178,67 @@ def wrapper(func):
     return wrapped
 
 
+class ReferenceLoader:
+    """
+    Request scoped batching loader of the documents joined by
+    :meth:`BaseRepository.join_db_refs`.
+
+    Lookups are coalesced until the next IOLoop iteration and sent as one $in
+    query per collection and projection, the results (None for missing ids)
+    are cached for the rest of the request.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.cache = {}
+        self.pending = {}
+        self.scheduled = False
+
+    @staticmethod
+    def key(collection, project):
+        return collection, tuple(sorted(project.items())) if project else None
+
+    def load(self, collection, _id, project=None):
+        """:returns a future of the document `_id` of `collection`"""
+        key = self.key(collection, project)
+        cached = self.cache.setdefault(key, {})
+        if _id not in cached:
+            cached[_id] = Future()
+            self.pending.setdefault(key, (collection, project, []))[2].append(_id)
+            if not self.scheduled:
+                self.scheduled = True
+                IOLoop.current().add_callback(self.dispatch)
+
+        return cached[_id]
+
+    def clear(self, collection):
+        for key in [key for key in self.cache if key[0] == collection]:
+            if key not in self.pending:
+                del self.cache[key]
+
+    @gen.coroutine
+    def dispatch(self):
+        self.scheduled = False
+        pending, self.pending = self.pending, {}
+        yield [self.fetch(key, collection, project, ids) for key, (collection, project, ids) in pending.items()]
+
+    @gen.coroutine
+    def fetch(self, key, collection, project, ids):
+        futures = self.cache[key]
+        try:
+            # a copy, drivers may add _id to the projection and change the key
+            items = yield self.context.repositories[collection].find({'_id': {'$in': ids}}, process_query=False,
+                                                                     project=dict(project) if project else None)
+        except Exception as e:
+            for _id in ids:
+                futures.pop(_id).set_exception(e)
+            return
+
+        found = {item['_id']: item for item in items}
+        for _id in ids:
+            futures[_id].set_result(found.get(_id))
+
+
 class BaseRepository:
     '''
     Base repository for interaction with pymotor
@@ -180,7 +294,20 @@ class BaseRepository:
             self.process_query(query)
 
         if just_one:
-            result = yield self.repo.find_one(query, project)
+            # only plain ids are cached, operator queries on _id ({"$in": ...}, {"$ne": ...}) go to mongo
+            cacheable = not project and list(query) == ['_id'] and isinstance(query['_id'], (ObjectId, str, int))
+            cache = self.cache if cacheable else None
+            result = cache.get(query['_id']) if cache is not None else None
+            if cache is not None:
+                DOCUMENT_CACHE_LOOKUPS.inc(self.collection_name, 'hit' if result else 'miss')
+
+            if result is None:
+                result = yield self.repo.find_one(query, project)
+                if result and cache is not None:
+                    cache.put(result)
+
+            if result:
+                self.on_load(result)
             result = yield self.join_db_refs(result, join_refs=join_refs, just_one=just_one, refs=refs)
 
             return self.model.from_dict(result, principal=principal,
@@ -200,9 +327,11 @@ class BaseRepository:
 
         results = []
         while (yield cursor.fetch_next):
+            document = cursor.next_object()
+            self.on_load(document)
             results.append(
                 self.model.from_dict(
-                    cursor.next_object(), principal=principal, update_fields=update_fields,
+                    document, principal=principal, update_fields=update_fields,
                     validate=validate, schema=schema
                 )
             )
@@ -230,7 +359,7 @@ class BaseRepository:
     # return_document = True - After | False - Before
     def find_and_update(self, query, update, project=None, return_document=True,
                         process_query=True, principal=None, update_fields=True, upsert=False, validate=False,
-                        schema=None, join_refs=False, refs=None):
+                        schema=None, join_refs=False, refs=None, sort=None):
         """
         Find and update one document from the database.
 
@@ -244,13 +373,18 @@ class BaseRepository:
         :parameter validate: - validate model returned from the repository
         :parameter schema: - validation schema
         :parameter join_refs: - join any db_refs inside the document
+        :parameter sort: - list of (field, direction) pairs choosing the document to update
         :return:
         """
         if process_query:
             self.process_query(query)
 
         result = yield self.repo.find_one_and_update(query, update, projection=project, return_document=return_document,
-                                                     upsert=upsert)
+                                                     upsert=upsert, sort=sort)
+        self.clear_refs()
+        self.evict(query)
+        if result:
+            self.on_load(result)
         result = yield self.join_db_refs(result, join_refs=join_refs, just_one=True, refs=refs)
 
         return self.model.from_dict(result, principal=principal, update_fields=update_fields,
@@ -290,6 +424,7 @@ class BaseRepository:
         if not isinstance(to_insert, list):
             self.on_pre_save(to_insert)
             to_insert = yield self._insert_or_replace_one(to_insert)
+            self.clear_refs()
 
             self.on_post_save(to_insert)
         elif to_insert:
@@ -333,10 +468,14 @@ class BaseRepository:
 
             result = yield self.repo.update_one(query, update)
             # new_document = yield self.repo.find_one({'_id': _id}) # timeit: maybe return idk ?
+            self.clear_refs()
+            self.evict(query)
 
             return result
 
         result = yield self.repo.update_many(query, update)
+        self.clear_refs()
+        self.evict(query)
         return result
 
     @gen.coroutine
@@ -354,6 +493,8 @@ class BaseRepository:
         self.on_pre_delete(query)
 
         result = yield self.repo.delete_many(query)
+        self.clear_refs()
+        self.evict(query)
         return result.deleted_count
 
     @gen.coroutine
@@ -373,57 +514,55 @@ class BaseRepository:
 
     @gen.coroutine
     def join_db_refs(self, objects, join_refs=False, just_one=True, refs=None):
+        """
+        Joins the documents referenced by the `refs` of the model, each ref is a
+        dict of the `field` holding the id, its `fmt` function, the referenced
+        `collection`, the `project`ion and the `dest` field receiving the
+        document (None when it does not exist).
+
+        Lookups go through the request :class:`ReferenceLoader`, one $in query
+        per collection for the whole request.
+        """
         if not refs:
             refs = self.model.refs if hasattr(self.model, 'refs') else None
 
         if not join_refs or not objects or not refs:
             return objects
 
-        if just_one:
-            for ref in refs:
-                field = ref['field']
-                dest = ref['dest']
-                collection = ref['collection']
-                fmt = ref['fmt']
-                project = ref['project']
-
-                if field in objects:
-                    item = yield self.context.repositories[collection] \
-                        .find({'_id': fmt(objects[field])}, just_one=just_one, process_query=False, project=project)
-                    objects[dest] = item
-            return objects
-
-        # Best item parsing O(refs * n * log n) + O(n) ... TODO: FASTER?
-        item_dict = {}
-        for ref in refs:
-            field = ref['field']
-            collection = ref['collection']
-            fmt = ref['fmt']
-            project = ref['project']
-
-            item_dict[field] = {}
-
-            ids = {fmt(object[field]) for object in objects}
-            ids.remove(None)
-
-            items = yield self.context.repositories[collection] \
-                .find({'_id': {'$in': ids}}, just_one=just_one, process_query=False, project=project)
+        loader = getattr(self.context, 'ref_loader', None) or ReferenceLoader(self.context)
 
-            for item in items:
-                item_dict[field][item['_id']] = item
-
-        for object in objects:
+        joins = []
+        for object in [objects] if just_one else objects:
             for ref in refs:
-                dest = ref['dest']
-                field = ref['field']
-                fmt = ref['fmt']
+                if object.get(ref['field']) is not None:
+                    _id = ref['fmt'](object[ref['field']])
+                    joins.append((object, ref['dest'], loader.load(ref['collection'], _id, ref.get('project'))))
 
-                if field in object:
-                    old = object[field]
-                    object[dest] = item_dict[field][fmt(old)]
+        items = yield [future for _, _, future in joins]
+        for (object, dest, _), item in zip(joins, items):
+            object[dest] = item
 
         return objects
 
+    def clear_refs(self):
+        """Drops the documents of the collection cached by the request loader, after a write"""
+        loader = getattr(self.context, 'ref_loader', None)
+        if loader is not None:
+            loader.clear(self.collection_name)
+
+    @property
+    def cache(self):
+        """The :class:`DocumentCache` of the collection, None unless DOCUMENT_CACHE configures one"""
+        config = getattr(self.context, 'config', None)
+        options = (getattr(config, 'DOCUMENT_CACHE', None) or {}).get(self.collection_name)
+        return get_document_cache(self.collection_name, **options) if options else None
+
+    def evict(self, query):
+        """Drops the documents a write on `query` may have changed from the document cache"""
+        cache = self.cache
+        if cache is not None:
+            cache.evict(query)
+
     def process_query(self, query):
         if '_id' in query and not isinstance(query['_id'], ObjectId):
             if isinstance(query['_id'], dict) and '$in' in query['_id']:
@@ -431,14 +570,17 @@ class BaseRepository:
             elif isinstance(query['_id'], str):
                 query['_id'] = ObjectId(query['_id'])
 
+    def on_load(self, object):
+        pass
+
     def on_pre_save(self, object):
         pass
 
     def on_post_save(self, object):
-        pass
+        self.evict({'_id': object['_id']})
 
     def on_pre_delete(self, query):
-        pass
+        self.evict(query)
 
     def on_post_delete(self, query):
         pass
@@ -0,0 +1,78 @@
+import copy
+import time
+from collections import OrderedDict
+
+from bson import BSON
+
+
+class DocumentCache:
+    '''
+    LRU cache of raw documents keyed by _id. Entries expire `ttl` seconds after
+    they were read, the cache holds at most `size` documents and, unless it is
+    0, `max_bytes` bytes of BSON. Documents are deep copied in and out so
+    callers can change the ones they get, embedded documents and lists included.
+    '''
+
+    def __init__(self, size=1024, ttl=60, max_bytes=0):
+        self.size = size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, _id):
+        entry = self.entries.get(_id)
+        if entry is None:
+            return None
+
+        expires, _, document = entry
+        if expires < time.monotonic():
+            self.pop(_id)
+            return None
+
+        self.entries.move_to_end(_id)
+        return copy.deepcopy(document)
+
+    def put(self, document):
+        _id = document['_id']
+        size = len(BSON.encode(document)) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        self.pop(_id)
+        self.entries[_id] = (time.monotonic() + self.ttl, size, copy.deepcopy(document))
+        self.bytes += size
+
+        while len(self.entries) > self.size or (self.max_bytes and self.bytes > self.max_bytes):
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+
+    def pop(self, _id):
+        entry = self.entries.pop(_id, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def evict(self, query):
+        '''Drops the documents a query on _id may match, every document for any other query'''
+        _id = query.get('_id') if query else None
+        if isinstance(_id, dict) and list(_id) == ['$in']:
+            for value in _id['$in']:
+                self.pop(value)
+        elif _id is not None and not isinstance(_id, dict):
+            self.pop(_id)
+        else:
+            self.entries.clear()
+            self.bytes = 0
+
+
+_caches = {}
+
+
+def get_document_cache(collection, **options):
+    '''Returns the cache shared by the repositories of `collection`, created with `options` on first use'''
+    if collection not in _caches:
+        _caches[collection] = DocumentCache(**options)
+
+    return _caches[collection]
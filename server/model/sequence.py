@@ -1,4 +1,8 @@
+from bson import ObjectId
+from tornado import gen
+
 from server.model import BaseModel, BaseRepository
+from server.sequence_codecs import LazySequence, get_codec, chunk_documents, decode
 
 
 class SequenceModel(BaseModel):
@@ -14,4 +18,144 @@ class SequenceModel(BaseModel):
 
 
 class SequenceRepository(BaseRepository):
+    '''
+    Sequences are stored with the SEQUENCE_CODEC codec, read documents hold a
+    :class:`LazySequence` decoded on first use.
+
+    Sequences longer than SEQUENCE_CHUNK_SIZE are split in the `sequence_chunk`
+    collection, their documents keep the metadata and a `chunks` field instead
+    of the `sequence`, read with :meth:`get_sequence`.
+    '''
     collection_name = 'sequence'
+    chunk_collection_name = 'sequence_chunk'
+
+    def __init__(self, models, database, context):
+        super(SequenceRepository, self).__init__(models, database, context)
+        self.chunks = database[self.chunk_collection_name]
+
+    @property
+    def codec(self):
+        return get_codec(self.context.config.SEQUENCE_CODEC)
+
+    @property
+    def chunk_size(self):
+        return self.context.config.SEQUENCE_CHUNK_SIZE
+
+    def is_chunked(self, sequence):
+        return isinstance(sequence, str) and len(sequence) > self.chunk_size
+
+    def encode(self, sequence):
+        if isinstance(sequence, LazySequence):
+            # saved back as read, never decoded
+            return sequence.raw
+
+        return self.codec.encode(sequence) if isinstance(sequence, str) else sequence
+
+    def on_load(self, object):
+        if 'sequence' in object and not isinstance(object['sequence'], str):
+            object['sequence'] = LazySequence(object['sequence'])
+
+    def on_pre_save(self, object):
+        # long sequences are encoded chunk by chunk
+        if 'sequence' in object and not self.is_chunked(object['sequence']):
+            object['sequence'] = self.encode(object['sequence'])
+
+    def on_post_save(self, object):
+        super(SequenceRepository, self).on_post_save(object)
+        self.on_load(object)
+
+    @gen.coroutine
+    def write_chunks(self, _id, sequence):
+        """
+        Replaces the chunks of the sequence document `_id`
+
+        :returns the `chunks` field of the document
+        """
+        documents = chunk_documents(_id, sequence, self.chunk_size, self.codec)
+        yield self.chunks.delete_many({'sequence': _id})
+        yield self.chunks.insert_many(documents)
+        return {'size': self.chunk_size, 'count': len(documents)}
+
+    @gen.coroutine
+    def get_sequence(self, _id, start=0, end=None):
+        """
+        Reads the letters `start` to `end` of a sequence, chunked sequences only
+        fetch the chunks overlapping the range.
+
+        :returns the sequence range, None when there is no such document
+        """
+        document = yield self.repo.find_one({'_id': ObjectId(_id)}, {'sequence': 1, 'sequence_size': 1, 'chunks': 1})
+        if document is None:
+            return None
+
+        if 'chunks' not in document:
+            return decode(document.get('sequence', ''))[start:end]
+
+        size = document['sequence_size']
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return ''
+
+        chunk_size = document['chunks']['size']
+        first, last = start // chunk_size, (end - 1) // chunk_size
+        cursor = self.chunks.find({'sequence': document['_id'], 'n': {'$gte': first, '$lte': last}}, {'data': 1}) \
+            .sort('n', 1)
+
+        parts = []
+        while (yield cursor.fetch_next):
+            parts.append(decode(cursor.next_object()['data']))
+
+        offset = first * chunk_size
+        return ''.join(parts)[start - offset:end - offset]
+
+    @gen.coroutine
+    def _insert_or_replace_one(self, document):
+        if self.is_chunked(document.get('sequence')):
+            document.setdefault('_id', ObjectId())
+            document['chunks'] = yield self.write_chunks(document['_id'], document.pop('sequence'))
+        elif '_id' in document:
+            # the sequence may have been chunked before
+            document.pop('chunks', None)
+            yield self.chunks.delete_many({'sequence': document['_id']})
+
+        result = yield super(SequenceRepository, self)._insert_or_replace_one(document)
+        return result
+
+    @gen.coroutine
+    def update(self, query, update, just_one=True, process_query=True):
+        if 'sequence' in update.get('$set', {}):
+            if process_query:
+                self.process_query(query)
+                process_query = False
+
+            ids = yield self.repo.distinct('_id', query)
+            if just_one:
+                ids = ids[:1]
+                query = {'_id': {'$in': ids}}
+
+            sequence = update['$set'].pop('sequence')
+            yield self.chunks.delete_many({'sequence': {'$in': ids}})
+            if self.is_chunked(sequence):
+                for _id in ids:
+                    update['$set']['chunks'] = yield self.write_chunks(_id, sequence)
+                update['$set'].setdefault('chunks', {'size': self.chunk_size,
+                                                     'count': -(-len(sequence) // self.chunk_size)})
+                update.setdefault('$unset', {})['sequence'] = ''
+            else:
+                update['$set']['sequence'] = self.encode(sequence)
+                update.setdefault('$unset', {})['chunks'] = ''
+
+        result = yield super(SequenceRepository, self).update(query, update, just_one, process_query)
+        return result
+
+    @gen.coroutine
+    def remove(self, query, process_query=True):
+        if process_query:
+            self.process_query(query)
+
+        ids = yield self.repo.distinct('_id', dict(query, chunks={'$exists': True}))
+        result = yield super(SequenceRepository, self).remove(query, process_query=False)
+        if ids:
+            yield self.chunks.delete_many({'sequence': {'$in': ids}})
+
+        return result
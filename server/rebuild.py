@@ -0,0 +1,213 @@
+import os
+from collections import Counter
+from concurrent.futures.process import ProcessPoolExecutor
+
+from pymongo import MongoClient
+
+from server.index.alphabets import find_alphabet
+from server.index.engines import sequence_hash
+from server.index.sequence_index import DEFAULT_ENGINE, add_sequence, all_shards, classify, load_shards, \
+    save_shards
+from server.sequence_codecs import decode
+from server.utils import logger
+
+READ_BATCH_SIZE = 1000
+PROGRESS_EVERY = 100000
+DRIFT_SAMPLES = 20
+
+PROJECTION = {'sequence_id': 1, 'type': 1, 'sequence': 1, 'chunks': 1}
+
+
+def unknown_type(sequence_type):
+    """True for a type that names no alphabet, the alphabet of such sequences is detected"""
+    return bool(sequence_type) and find_alphabet(sequence_type) is None
+
+
+def range_path(idx_dir, part):
+    return os.path.join(idx_dir, 'idx_rebuild.{}.pk'.format(part))
+
+
+def read_sequences(db, query, batch_size=READ_BATCH_SIZE):
+    """
+    Streams the (sequence_id, type, sequence) of the documents matching `query`
+    with a batched cursor, chunked sequences are read back from their chunks.
+    """
+    cursor = db.sequence.find(query, PROJECTION, no_cursor_timeout=True).batch_size(batch_size)
+    try:
+        for document in cursor:
+            if 'chunks' in document:
+                chunks = db.sequence_chunk.find({'sequence': document['_id']}, {'data': 1}).sort('n', 1)
+                sequence = ''.join([decode(chunk['data']) for chunk in chunks])
+            else:
+                sequence = decode(document.get('sequence', ''))
+
+            yield document.get('sequence_id'), document.get('type'), sequence
+    finally:
+        cursor.close()
+
+
+def id_ranges(db, parts, batch_size=READ_BATCH_SIZE):
+    """
+    Splits the `sequence` collection in at most `parts` queries on contiguous
+    ranges of _id holding the same number of documents.
+    """
+    count = db.sequence.count_documents({})
+    step = -(-count // parts) if count else 0
+    if parts <= 1 or step == 0:
+        return [{}]
+
+    cursor = db.sequence.find({}, {'_id': 1}).sort('_id', 1).batch_size(batch_size)
+    bounds = [document['_id'] for index, document in enumerate(cursor) if index and index % step == 0]
+
+    lowers, uppers = [None] + bounds, bounds + [None]
+    queries = []
+    for lower, upper in zip(lowers, uppers):
+        condition = {}
+        if lower is not None:
+            condition['$gte'] = lower
+        if upper is not None:
+            condition['$lt'] = upper
+        queries.append({'_id': condition} if condition else {})
+
+    return queries
+
+
+def build_range(db_url, db, query, path, engine=DEFAULT_ENGINE, shard_options=None, batch_size=READ_BATCH_SIZE):
+    """
+    Builds the shards of the sequences matching `query` and saves them in `path`.
+
+    :returns the number of indexed sequences and of sequences with an unknown type
+    """
+    db = MongoClient(db_url, connectTimeoutMS=2)[db]
+
+    by_type, count, unknown_types = {}, 0, 0
+    for sequence_id, sequence_type, sequence in read_sequences(db, query, batch_size):
+        unknown_types += unknown_type(sequence_type)
+        add_sequence(by_type, engine, sequence_id, sequence, sequence_type, **(shard_options or {}))
+        count += 1
+        if count % PROGRESS_EVERY == 0:
+            logger.info('Indexed {} sequences of {}'.format(count, path))
+
+    if unknown_types:
+        logger.warning('{} sequences of {} have an unknown type, their alphabet was detected'.format(
+            unknown_types, path))
+
+    save_shards(all_shards(by_type), path)
+    return count, unknown_types
+
+
+def hash_range(db_url, db, query, batch_size=READ_BATCH_SIZE):
+    """
+    :returns the Counter of (sequence_id, type, content hash) of the sequences
+    matching `query` and the number of them with an unknown type
+    """
+    db = MongoClient(db_url, connectTimeoutMS=2)[db]
+
+    entries, unknown_types = Counter(), 0
+    for sequence_id, sequence_type, sequence in read_sequences(db, query, batch_size):
+        unknown_types += unknown_type(sequence_type)
+        alphabet, encoded = classify(sequence, sequence_type)
+        entries[sequence_id, alphabet.name, sequence_hash(encoded)] += 1
+
+    return entries, unknown_types
+
+
+def run_ranges(workers, calls):
+    """Runs the (function, arguments) calls in `workers` processes, a single call runs in this process"""
+    if workers <= 1 or len(calls) == 1:
+        return [function(*arguments) for function, arguments in calls]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(function, *arguments) for function, arguments in calls]
+        return [future.result() for future in futures]
+
+
+def build_index(db_url, db, idx_dir, workers=0, engine=DEFAULT_ENGINE, shard_options=None,
+                batch_size=READ_BATCH_SIZE):
+    """
+    Rebuilds idx.pk from the `sequence` collection without touching it: the
+    collection is split in one _id range per worker, every worker streams its
+    range and builds its shards, the shards are then saved together and
+    replace the index in one rename. `workers` <= 0 means one per cpu.
+
+    :returns a report of the number of `indexed` sequences and of the ones
+    whose type names no alphabet (`unknown_types`), indexed with the detected one
+    """
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    queries = id_ranges(MongoClient(db_url, connectTimeoutMS=2)[db], workers, batch_size)
+    paths = [range_path(idx_dir, part) for part in range(len(queries))]
+
+    try:
+        results = run_ranges(workers, [(build_range, (db_url, db, query, path, engine, shard_options, batch_size))
+                                       for query, path in zip(queries, paths)])
+
+        shards = [shard for path in paths for shard in load_shards(path)]
+        save_shards(shards, os.path.join(idx_dir, 'idx_new.pk'))
+        os.replace(os.path.join(idx_dir, 'idx_new.pk'), os.path.join(idx_dir, 'idx.pk'))
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    return {'indexed': sum(count for count, _ in results),
+            'unknown_types': sum(unknown_types for _, unknown_types in results)}
+
+
+def index_entries(shards):
+    """:returns the Counter of (sequence_id, type, content hash) of the index"""
+    entries = Counter()
+    for shard in shards:
+        for node in shard:
+            for name in node['names']:
+                entries[name, getattr(shard, 'sequence_type', None), node['hash']] += 1
+
+    return entries
+
+
+def verify_index(db_url, db, idx_dir, workers=0, batch_size=READ_BATCH_SIZE):
+    """
+    Compares idx.pk with the `sequence` collection, streamed in one _id range
+    per worker. Shards saved before the index was split by sequence type match
+    any type.
+
+    :returns a report of the sequences `missing` from the index, the index
+    entries without a sequence (`orphaned`) and the sequences whose content or
+    type changed since they were indexed (`changed`), with a sample of their ids,
+    and the number of sequences whose type names no alphabet (`unknown_types`)
+    """
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    queries = id_ranges(MongoClient(db_url, connectTimeoutMS=2)[db], workers, batch_size)
+    stored, unknown_types = Counter(), 0
+    for counter, unknown in run_ranges(workers, [(hash_range, (db_url, db, query, batch_size)) for query in queries]):
+        stored.update(counter)
+        unknown_types += unknown
+
+    idx_path = os.path.join(idx_dir, 'idx.pk')
+    indexed = index_entries(load_shards(idx_path) if os.path.exists(idx_path) else [])
+
+    # untyped shards match the type of the stored sequence
+    types = {(sequence_id, key): sequence_type for sequence_id, sequence_type, key in stored}
+    for entry in [entry for entry in indexed if entry[1] is None]:
+        stored_type = types.get((entry[0], entry[2]))
+        if stored_type is not None:
+            indexed[entry[0], stored_type, entry[2]] += indexed.pop(entry)
+
+    missing, orphaned = stored - indexed, indexed - stored
+    changed = {entry[0] for entry in missing} & {entry[0] for entry in orphaned}
+
+    def sample(names):
+        return sorted(name for name in names if name is not None)[:DRIFT_SAMPLES]
+
+    return {
+        'stored': sum(stored.values()),
+        'indexed': sum(indexed.values()),
+        'missing': sum(count for entry, count in missing.items() if entry[0] not in changed),
+        'orphaned': sum(count for entry, count in orphaned.items() if entry[0] not in changed),
+        'changed': len(changed),
+        'unknown_types': unknown_types,
+        'samples': {
+            'missing': sample({entry[0] for entry in missing} - changed),
+            'orphaned': sample({entry[0] for entry in orphaned} - changed),
+            'changed': sample(changed)
+        }
+    }
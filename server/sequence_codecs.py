@@ -0,0 +1,128 @@
+import struct
+import zlib
+from itertools import product
+
+from bson.binary import Binary
+
+from server.importer import import_class
+
+# user defined bson binary subtypes, encoded values describe their own codec
+ZLIB_SUBTYPE = 0x80
+PACKED_SUBTYPE = 0x81
+
+NUCLEOTIDES = 'ACGT'
+PACK = {''.join(letters): bytes([code]) for code, letters in enumerate(product(NUCLEOTIDES, repeat=4))}
+UNPACK = {code[0]: letters for letters, code in PACK.items()}
+
+
+class SequenceCodec:
+    '''
+    Storage codec of the `sequence` field of the sequence documents. Encoded
+    values are either plain strings or bson binaries whose subtype names the
+    codec, so :func:`decode` reads every stored value whatever the codec
+    configured when it was written.
+    '''
+
+    def encode(self, sequence):
+        raise NotImplementedError()
+
+
+class PlainCodec(SequenceCodec):
+    '''Stores sequences as plain strings'''
+
+    def encode(self, sequence):
+        return sequence
+
+
+class ZlibCodec(SequenceCodec):
+    '''Stores sequences zlib compressed'''
+
+    level = 6
+
+    def encode(self, sequence):
+        return Binary(zlib.compress(sequence.encode('utf-8'), self.level), ZLIB_SUBTYPE)
+
+
+class PackedCodec(ZlibCodec):
+    '''
+    Packs upper case ACGT sequences in 2 bits per nucleotide, behind a 4 byte
+    length header. Any other sequence is zlib compressed.
+    '''
+
+    def encode(self, sequence):
+        if sequence.strip(NUCLEOTIDES):
+            return super(PackedCodec, self).encode(sequence)
+
+        padded = sequence + 'A' * (-len(sequence) % 4)
+        return Binary(struct.pack('>I', len(sequence)) +
+                      b''.join([PACK[padded[i:i + 4]] for i in range(0, len(padded), 4)]), PACKED_SUBTYPE)
+
+
+def decode(value):
+    if isinstance(value, str):
+        return value
+
+    if value.subtype == ZLIB_SUBTYPE:
+        return zlib.decompress(value).decode('utf-8')
+
+    if value.subtype == PACKED_SUBTYPE:
+        length, = struct.unpack_from('>I', value)
+        return ''.join([UNPACK[code] for code in value[4:]])[:length]
+
+    raise ValueError('Unknown sequence encoding, binary subtype {}'.format(value.subtype))
+
+
+def chunk_documents(parent_id, sequence, chunk_size, codec):
+    '''
+    Splits `sequence` in `sequence_chunk` documents of `chunk_size` letters
+    encoded with `codec`, numbered by their position `n`.
+    '''
+    return [{'sequence': parent_id, 'n': n, 'data': codec.encode(sequence[start:start + chunk_size])}
+            for n, start in enumerate(range(0, len(sequence), chunk_size))]
+
+
+class LazySequence:
+    '''
+    Encoded sequence read from the database, decoded on its first use (str(),
+    len(), comparisons or serialization) so documents whose sequence is never
+    used never pay for the decoding.
+    '''
+
+    __slots__ = ('raw', 'decoded')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.decoded = None
+
+    @property
+    def value(self):
+        if self.decoded is None:
+            self.decoded = decode(self.raw)
+
+        return self.decoded
+
+    def __str__(self):
+        return self.value
+
+    def __repr__(self):
+        return 'LazySequence({!r})'.format(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __eq__(self, other):
+        return self.value == (other.value if isinstance(other, LazySequence) else other)
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+_codecs = {}
+
+
+def get_codec(name):
+    '''Returns a shared instance of the codec class declared by its full python path'''
+    if name not in _codecs:
+        _codecs[name] = import_class(name)()
+
+    return _codecs[name]
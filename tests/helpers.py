@@ -0,0 +1,11 @@
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def mutate(rng, sequence, rate):
+    letters = list(sequence)
+    for position in range(len(letters)):
+        if rng.random() < rate:
+            letters[position] = rng.choice('ACGT')
+
+    return ''.join(letters)
@@ -0,0 +1,104 @@
+from bson import BSON
+
+from server.model import cache
+from server.model.cache import DocumentCache, get_document_cache
+
+
+def test_get_returns_a_copy():
+    documents = DocumentCache()
+    documents.put({'_id': 1, 'extra': {'tags': ['a']}})
+
+    document = documents.get(1)
+    document['extra']['tags'].append('b')
+    document['name'] = 'changed'
+
+    assert documents.get(1) == {'_id': 1, 'extra': {'tags': ['a']}}
+
+
+def test_put_stores_a_copy():
+    document = {'_id': 1, 'extra': {'tags': ['a']}}
+    documents = DocumentCache()
+    documents.put(document)
+
+    document['extra']['tags'].append('b')
+
+    assert documents.get(1)['extra']['tags'] == ['a']
+
+
+def test_least_recently_used_documents_are_dropped():
+    documents = DocumentCache(size=2)
+    documents.put({'_id': 1})
+    documents.put({'_id': 2})
+    documents.get(1)
+    documents.put({'_id': 3})
+
+    assert len(documents) == 2
+    assert documents.get(2) is None
+    assert documents.get(1) == {'_id': 1}
+    assert documents.get(3) == {'_id': 3}
+
+
+def test_documents_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+
+    documents = DocumentCache(ttl=10)
+    documents.put({'_id': 1})
+
+    now[0] += 9
+    assert documents.get(1) == {'_id': 1}
+
+    now[0] += 2
+    assert documents.get(1) is None
+    assert len(documents) == 0
+
+
+def test_max_bytes():
+    document = {'_id': 1, 'sequence': 'A' * 100}
+    size = len(BSON.encode(document))
+    documents = DocumentCache(max_bytes=2 * size)
+
+    for _id in range(3):
+        documents.put(dict(document, _id=_id))
+
+    assert len(documents) == 2
+    assert documents.bytes == 2 * size
+    assert documents.get(0) is None
+
+    documents.put({'_id': 'large', 'sequence': 'A' * 3 * size})
+    assert documents.get('large') is None
+    assert documents.bytes == 2 * size
+
+
+def test_evict():
+    documents = DocumentCache()
+    for _id in range(5):
+        documents.put({'_id': _id})
+
+    documents.evict({'_id': 0})
+    assert documents.get(0) is None
+
+    documents.evict({'_id': {'$in': [1, 2]}})
+    assert [documents.get(_id) for _id in range(5)] == [None, None, None, {'_id': 3}, {'_id': 4}]
+
+    documents.evict({'_id': {'$gt': 3}})
+    assert len(documents) == 0
+
+
+def test_evict_any_other_query_clears_the_cache():
+    documents = DocumentCache(max_bytes=1000)
+    documents.put({'_id': 1})
+    documents.put({'_id': 2})
+
+    documents.evict({'sequence_id': 'seq1'})
+
+    assert len(documents) == 0
+    assert documents.bytes == 0
+
+
+def test_caches_are_shared_per_collection():
+    first = get_document_cache('test_shared', size=3)
+
+    assert get_document_cache('test_shared', size=10) is first
+    assert first.size == 3
+    assert get_document_cache('test_other') is not first
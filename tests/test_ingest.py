@@ -0,0 +1,123 @@
+import os
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+import pytest
+
+from server import ingest
+from server.index.sequence_index import add_sequence, all_shards, load_shards, save_shards
+
+
+class FakeCollection:
+    def __init__(self):
+        self.updates = []
+
+    def update_one(self, query, update, upsert=False):
+        self.updates.append((query, update))
+
+
+class FakeMongoClient:
+    """Stands for the job collection the merge reports its progress to"""
+
+    def __init__(self, *args, **kwargs):
+        self.job = FakeCollection()
+
+    def __getitem__(self, name):
+        return self
+
+
+def write_partitions(idx_dir, job_id, names):
+    for partition, name in enumerate(names):
+        by_type = {}
+        add_sequence(by_type, ingest.DEFAULT_ENGINE, name, 'ACGT' * 10 + name)
+        shards = all_shards(by_type)
+        for shard in shards:
+            shard.job_id = job_id
+        save_shards(shards, ingest.partition_path(idx_dir, job_id, partition))
+
+
+def indexed_names(idx_dir):
+    return sorted(name for shard in load_shards(os.path.join(idx_dir, 'idx.pk')) for node in shard
+                  for name in node['names'])
+
+
+def test_merge_appends_to_the_index(tmpdir, monkeypatch):
+    monkeypatch.setattr(ingest, 'MongoClient', FakeMongoClient)
+    idx_dir = str(tmpdir)
+
+    write_partitions(idx_dir, 'first', ['A', 'C'])
+    ingest.merge_partitions('url', 'db', 'first', idx_dir, 2)
+    write_partitions(idx_dir, 'second', ['G'])
+    ingest.merge_partitions('url', 'db', 'second', idx_dir, 1)
+
+    assert indexed_names(idx_dir) == ['A', 'C', 'G']
+    assert not [path for path in os.listdir(idx_dir) if path != 'idx.pk']
+
+
+def test_merge_is_idempotent_on_the_job_id(tmpdir, monkeypatch):
+    monkeypatch.setattr(ingest, 'MongoClient', FakeMongoClient)
+    idx_dir = str(tmpdir)
+
+    write_partitions(idx_dir, 'job', ['A', 'C'])
+    ingest.merge_partitions('url', 'db', 'job', idx_dir, 2)
+
+    # a job resumed after the merge wrote idx.pk, with its partitions built again
+    write_partitions(idx_dir, 'job', ['A', 'C'])
+    ingest.merge_partitions('url', 'db', 'job', idx_dir, 2)
+
+    assert indexed_names(idx_dir) == ['A', 'C']
+    assert not [path for path in os.listdir(idx_dir) if path != 'idx.pk']
+
+
+def test_merge_of_a_resumed_job_without_partitions(tmpdir, monkeypatch):
+    monkeypatch.setattr(ingest, 'MongoClient', FakeMongoClient)
+    idx_dir = str(tmpdir)
+
+    write_partitions(idx_dir, 'job', ['A'])
+    ingest.merge_partitions('url', 'db', 'job', idx_dir, 1)
+    # partition files already removed by the first merge
+    ingest.merge_partitions('url', 'db', 'job', idx_dir, 1)
+
+    assert indexed_names(idx_dir) == ['A']
+
+
+def test_merge_compacts_the_smallest_shards(tmpdir, monkeypatch):
+    monkeypatch.setattr(ingest, 'MongoClient', FakeMongoClient)
+    idx_dir = str(tmpdir)
+
+    for job_id, names in [('first', ['A', 'C', 'G']), ('second', ['T']), ('third', ['AA'])]:
+        write_partitions(idx_dir, job_id, names)
+        ingest.merge_partitions('url', 'db', job_id, idx_dir, len(names), max_shards=2)
+
+    shards = load_shards(os.path.join(idx_dir, 'idx.pk'))
+    assert sorted(len(shard) for shard in shards) == [2, 3]
+    assert indexed_names(idx_dir) == ['A', 'AA', 'C', 'G', 'T']
+
+    # the merged shard still marks its jobs as merged
+    write_partitions(idx_dir, 'second', ['T'])
+    ingest.merge_partitions('url', 'db', 'second', idx_dir, 1, max_shards=2)
+    assert indexed_names(idx_dir) == ['A', 'AA', 'C', 'G', 'T']
+
+
+def test_only_broken_pools_are_replaced():
+    queue = ingest.IngestQueue()
+    queue.config = SimpleNamespace(INDEX_BUILD_WORKERS=1)
+    queue.workers = 1
+    queue.create_executors()
+    executor, merge_executor, index_executor = queue.executor, queue.merge_executor, queue.index_executor
+
+    with pytest.raises(BrokenProcessPool):
+        merge_executor.submit(os._exit, 1).result()
+
+    queue.reset_executors()
+    assert queue.merge_executor is not merge_executor
+    assert queue.executor is executor and queue.index_executor is index_executor
+
+    # another job failing on the replaced pool
+    replaced = queue.merge_executor
+    queue.reset_executors()
+    assert queue.merge_executor is replaced
+
+    queue.executor.shutdown()
+    queue.merge_executor.shutdown()
+    ingest._index_executors.pop(queue.partitions).shutdown()
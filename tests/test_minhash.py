@@ -0,0 +1,43 @@
+import random
+
+from server.index.minhash import LSHIndex, sketch, similarity
+from server.index.sequence_index import QueryStats
+from tests.helpers import mutate, random_sequence
+
+
+def test_sketches_are_stable():
+    sequence = random_sequence(random.Random(0), 300)
+
+    assert sketch(sequence, 60, 8) == sketch(sequence, 60, 8)
+    assert similarity(sketch(sequence, 60, 8), sketch(sequence, 60, 8)) == 1
+
+
+def test_similar_sequences_are_found():
+    rng = random.Random(0)
+    nodes = [{'sequence': random_sequence(rng, 400)} for _ in range(500)]
+    lsh = LSHIndex(20, 3, 8)
+    for node in nodes:
+        lsh.add(node)
+
+    found = 0
+    for _ in range(50):
+        node = rng.choice(nodes)
+        query = mutate(rng, node['sequence'], 0.02)
+        if any(candidate is node for _, candidate in lsh.candidates(query, 0.3, QueryStats())):
+            found += 1
+
+    assert found >= 47
+
+
+def test_dissimilar_sequences_are_screened_out():
+    rng = random.Random(1)
+    nodes = [{'sequence': random_sequence(rng, 400)} for _ in range(500)]
+    lsh = LSHIndex(20, 3, 8)
+    for node in nodes:
+        lsh.add(node)
+
+    stats = QueryStats()
+    candidates = lsh.candidates(random_sequence(rng, 400), 0.3, stats)
+
+    assert candidates == []
+    assert stats.nodes_visited < len(nodes) // 10
@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+from bson import ObjectId
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from server.model import BaseModel, BaseRepository
+
+
+class FakeCollection:
+    """Stands for a motor collection, counts the reads that reach it"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.reads = 0
+
+    def matches(self, query, document):
+        _id = query.get('_id')
+        if isinstance(_id, dict):
+            return document['_id'] in _id.get('$in', [])
+
+        return _id is None or document['_id'] == _id
+
+    @gen.coroutine
+    def find_one(self, query, project=None):
+        self.reads += 1
+        return next((dict(document) for document in self.documents if self.matches(query, document)), None)
+
+    @gen.coroutine
+    def delete_many(self, query):
+        deleted = [document for document in self.documents if self.matches(query, document)]
+        self.documents = [document for document in self.documents if document not in deleted]
+        return SimpleNamespace(deleted_count=len(deleted))
+
+
+class ThingRepository(BaseRepository):
+    collection_name = 'test_thing'
+
+
+def repository(documents):
+    config = SimpleNamespace(DOCUMENT_CACHE={'test_thing': {'size': 10, 'ttl': 60}})
+    database = {'test_thing': FakeCollection(documents)}
+    repo = ThingRepository({'test_thing': BaseModel}, database, SimpleNamespace(config=config))
+    repo.cache.evict(None)
+    return repo
+
+
+def test_reads_by_id_are_cached():
+    _id = ObjectId()
+    repo = repository([{'_id': _id, 'name': 'first'}])
+
+    for _ in range(2):
+        assert IOLoop.current().run_sync(lambda: repo.find_one({'_id': str(_id)}))['name'] == 'first'
+
+    assert repo.repo.reads == 1
+
+
+def test_operator_ids_bypass_the_cache():
+    ids = [ObjectId(), ObjectId()]
+    repo = repository([{'_id': _id, 'name': str(_id)} for _id in ids])
+
+    found = IOLoop.current().run_sync(lambda: repo.find_one({'_id': {'$in': [str(ids[1])]}}))
+    assert found['name'] == str(ids[1])
+    found = IOLoop.current().run_sync(lambda: repo.find_one({'_id': {'$in': [str(ids[1])]}}))
+    assert found['name'] == str(ids[1])
+
+    assert repo.repo.reads == 2
+    assert len(repo.cache) == 0
+
+
+def test_removed_documents_are_evicted():
+    _id = ObjectId()
+    repo = repository([{'_id': _id, 'name': 'first'}])
+
+    IOLoop.current().run_sync(lambda: repo.find_one({'_id': _id}))
+    IOLoop.current().run_sync(lambda: repo.remove({'_id': _id}))
+
+    assert IOLoop.current().run_sync(lambda: repo.find_one({'_id': _id})) is None
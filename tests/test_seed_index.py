@@ -0,0 +1,64 @@
+import random
+
+import editdistance
+
+from server.index.seeds import SeedIndex, extend
+from server.index.sequence_index import QueryStats
+from tests.helpers import mutate, random_sequence
+
+
+def build(rng, count, length, stride):
+    nodes = [{'sequence': random_sequence(rng, length)} for _ in range(count)]
+    seeds = SeedIndex(11, stride)
+    for node in nodes:
+        seeds.add(node)
+
+    return nodes, seeds
+
+
+def best_hit(seeds, query, band, max_distance):
+    hits = []
+    for _, node, diagonal in seeds.candidates(query, band, QueryStats()):
+        hit = extend(query, node['sequence'], diagonal, band, max_distance)
+        if hit is not None:
+            hits.append((hit[0], node, hit[1], hit[2]))
+
+    return min(hits, key=lambda hit: hit[0]) if hits else None
+
+
+def test_fragments_are_found():
+    rng = random.Random(0)
+    nodes, seeds = build(rng, 200, 1000, 4)
+
+    found = 0
+    for _ in range(50):
+        node = rng.choice(nodes)
+        start = rng.randrange(0, 800)
+        query = mutate(rng, node['sequence'][start:start + 200], 0.02)
+
+        hit = best_hit(seeds, query, 32, 20)
+        if hit is not None and hit[1] is node and abs(hit[2] - start) <= 5:
+            found += 1
+
+    assert found >= 48
+
+
+def test_extend_finds_the_fragment_range():
+    rng = random.Random(1)
+    subject = random_sequence(rng, 500)
+    query = subject[100:200]
+
+    assert extend(query, subject, 100, 8, 5) == (0, 100, 200)
+
+    mutated = query[:50] + query[51:]
+    distance, start, end = extend(mutated, subject, 100, 8, 5)
+    assert distance == 1
+    assert editdistance.eval(mutated, subject[start:end]) == 1
+
+
+def test_unrelated_queries_find_nothing():
+    rng = random.Random(2)
+    _, seeds = build(rng, 100, 1000, 4)
+
+    query = random_sequence(rng, 200)
+    assert best_hit(seeds, query, 32, 20) is None
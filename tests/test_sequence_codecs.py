@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from server.sequence_codecs import PlainCodec, ZlibCodec, PackedCodec, LazySequence, decode, chunk_documents
+
+CODECS = [PlainCodec(), ZlibCodec(), PackedCodec()]
+
+SEQUENCES = [
+    '',
+    'A',
+    'ACG',
+    'ACGT',
+    'ACGTA',
+    'ACGTNNACGT',
+    'acgtacgt',
+    'MKVLAAGIVGLLLA*',
+    'ACGT-ACGT\nACGT',
+    ''.join(random.Random(0).choice('ACGT') for _ in range(1001)),
+]
+
+
+@pytest.mark.parametrize('codec', CODECS, ids=lambda codec: type(codec).__name__)
+@pytest.mark.parametrize('sequence', SEQUENCES)
+def test_round_trip(codec, sequence):
+    assert decode(codec.encode(sequence)) == sequence
+
+
+def test_packed_codec_packs_nucleotides():
+    sequence = 'ACGT' * 100
+    encoded = PackedCodec().encode(sequence)
+
+    assert len(encoded) == 4 + len(sequence) // 4
+    assert decode(encoded) == sequence
+
+
+def test_values_decode_whatever_the_configured_codec():
+    values = [codec.encode('ACGTTGCA') for codec in CODECS]
+
+    assert [decode(value) for value in values] == ['ACGTTGCA'] * len(CODECS)
+
+
+def test_lazy_sequence():
+    sequence = LazySequence(ZlibCodec().encode('ACGTACGT'))
+
+    assert sequence.decoded is None
+    assert len(sequence) == 8
+    assert sequence == 'ACGTACGT'
+    assert str(sequence) == 'ACGTACGT'
+
+
+def test_chunk_documents():
+    sequence = ''.join(random.Random(1).choice('ACGT') for _ in range(25))
+    chunks = chunk_documents('parent', sequence, 10, PackedCodec())
+
+    assert [chunk['n'] for chunk in chunks] == [0, 1, 2]
+    assert all(chunk['sequence'] == 'parent' for chunk in chunks)
+    assert ''.join(decode(chunk['data']) for chunk in chunks) == sequence
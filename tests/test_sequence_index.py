@@ -0,0 +1,99 @@
+import os
+
+import dill
+import pybktree
+
+from server.index.engines import sequence_distance
+from server.index.sequence_index import SequenceIndex, QueryStats, add_sequence, all_shards, classify, \
+    iter_shards, load_shards, save_shards
+
+
+def test_classify_matches_the_type_in_any_case():
+    assert classify('acgtacgt', 'DNA')[0].name == 'dna'
+    assert classify('ACGU', ' Rna ')[0].name == 'rna'
+    assert classify('ACGT', 'protein')[0].name == 'protein'
+
+
+def test_classify_detects_unknown_types():
+    assert classify('acgtacgtac', 'genomic') == classify('acgtacgtac')
+    assert classify('MKVLAAGIV', 'CDS')[0].name == 'protein'
+
+
+def test_legacy_trees_are_searched_in_encoded_form(tmpdir):
+    tree = pybktree.BKTree(sequence_distance)
+    for name, sequence in [('lower', 'acgtacgtaa'), ('upper', 'ACGTACGTAA'), ('gapped', 'ACGT-ACGTTT')]:
+        tree.add({'name': name, 'sequence': sequence})
+    with open(os.path.join(str(tmpdir), 'idx.pk'), 'wb') as file:
+        dill.dump(tree, file)
+
+    idx = SequenceIndex()
+    idx.load(str(tmpdir), force=True)
+
+    found = idx.find({'sequence': 'acgtacgtaa'}, 0, stats=QueryStats())
+    assert [sorted(node['names']) for _, node, _ in found] == [['lower', 'upper']]
+    found = idx.find({'sequence': 'ACGTACGTTT'}, 0, stats=QueryStats())
+    assert [node['names'] for _, node, _ in found] == [['gapped']]
+
+
+def build_shards(names):
+    by_type = {}
+    for name in names:
+        add_sequence(by_type, 'server.index.engines.BKTreeEngine', name, 'ACGT' * 5 + name)
+
+    return all_shards(by_type)
+
+
+def test_shards_are_saved_one_pickle_each(tmpdir):
+    path = os.path.join(str(tmpdir), 'idx.pk')
+    save_shards(build_shards(['A', 'C']) + build_shards(['G']), path)
+
+    with open(path, 'rb') as file:
+        assert dill.load(file)['shards'] == 2
+        assert [len(dill.load(file)) for _ in range(2)] == [2, 1]
+
+    with open(path, 'rb') as file:
+        shards = list(iter_shards(file))
+
+    assert [sorted(name for node in shard for name in node['names']) for shard in shards] == [['A', 'C'], ['G']]
+
+
+def test_single_pickle_indexes_still_load(tmpdir):
+    path = os.path.join(str(tmpdir), 'idx.pk')
+    with open(path, 'wb') as file:
+        dill.dump(build_shards(['A']) + build_shards(['C']), file)
+
+    assert [len(shard) for shard in load_shards(path)] == [1, 1]
+
+
+def test_missing_seed_indexes_are_built_in_the_background():
+    idx = SequenceIndex()
+    idx.use_shards('', build_shards(['A', 'C']))
+    item = {'sequence': 'ACGT' * 5 + 'A'}
+
+    stats = QueryStats()
+    assert idx.find_local(item, 2, stats=stats) == []
+    assert stats.partial and idx.estimate_cost(item, 'local') < 10000
+
+    for build in idx.lazy_builds.values():
+        build.result()
+
+    stats = QueryStats()
+    assert [hit[1]['names'] for hit in idx.find_local(item, 2, stats=stats)][0] == ['A']
+    assert not stats.partial
+
+
+def test_indexes_built_in_the_background_are_kept_on_reload(tmpdir):
+    path = os.path.join(str(tmpdir), 'idx.pk')
+    save_shards(build_shards(['A', 'C']), path)
+
+    idx = SequenceIndex()
+    idx.load(str(tmpdir), force=True)
+    idx.find_local({'sequence': 'ACGT' * 5 + 'A'}, 2, stats=QueryStats())
+    for build in idx.lazy_builds.values():
+        build.result()
+
+    idx.load(str(tmpdir), force=True)
+    seeds = idx.shards[0].seeds
+
+    assert seeds is not None
+    assert all(node is idx.shards[0].nodes[node['hash']] for node in seeds.nodes)
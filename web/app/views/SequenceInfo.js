@@ -154,14 +154,29 @@ class SequenceInfo extends React.Component {
         axios.get('/api/crud/sequence', {params: {just_one: true, _query: {sequence_id: this._id}}})
             .then((response) => {
                 window.scrollTo(0, 0);
+                if (response.data.chunks)
+                    return this.loadBody(response.data);
                 this.setState({loading: false, loadingSimilar: true, item: response.data}, () => this.getSimilar());
             }, () => {
             });
 
     };
 
+    // long sequences are stored apart from their document
+    loadBody = (item) => {
+        axios.get(`/api/sequence/${item._id}/body`)
+            .then((response) => {
+                this.setState({
+                    loading: false,
+                    loadingSimilar: true,
+                    item: {...item, sequence: response.data.sequence}
+                }, () => this.getSimilar());
+            }, () => {
+            });
+    };
+
     getSimilar = () => {
-        axios.post('/api/sequence/query', {seq: this.state.item.sequence, dist: this.state.distance})
+        axios.post('/api/sequence/query', {seq: this.state.item.sequence, type: this.state.item.type, dist: this.state.distance})
             .then((response) => {
                 this.setState({
                     loadingSimilar: false,
@@ -19,10 +19,10 @@ class UploadSequence extends React.Component {
 
     getUpload = () => {
         this.setState({loading: true}, () => {
-            axios.get('/api/sequence/upload')
+            axios.get(this.state.jobId ? `/api/sequence/upload/${this.state.jobId}` : '/api/sequence/upload')
                 .then((response) => {
                     if (response.status === 200)
-                        this.setState({loading: false, canUpload: true});
+                        this.setState({loading: false, canUpload: true, jobId: null});
 
                     if (response.status === 206) {
                         this.setState({loading: false, canUpload: false, job: response.data});
@@ -45,7 +45,7 @@ class UploadSequence extends React.Component {
                 'content-type': 'multipart/form-data'
             }
         }).then((result) => {
-            this.getUpload();
+            this.setState({jobId: result.data._id}, this.getUpload);
         }, () => {
             this.getUpload();
         });